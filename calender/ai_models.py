@@ -0,0 +1,27 @@
+# Pydantic models for structured AI output. Separate from gpt.py so that pydantic is only imported when one is used.
+from pydantic import BaseModel
+from typing import Optional
+
+
+# CalendarEvent model for storing event details, used in parsing responses from OpenAI
+class CalendarEvent(BaseModel):
+    title: str
+    description: str
+    when: str
+    location: str
+    participants: list[str]
+
+
+# Participant and FullCalendarEvent models, for getting everything in one call to OpenAI.
+class Participant(BaseModel):
+    name: str
+    email: Optional[str]
+
+
+class FullCalendarEvent(BaseModel):
+    title: str
+    description: str
+    when: str
+    end: str
+    location: str
+    participants: list[Participant]
@@ -0,0 +1,94 @@
+# Per-channel directory of who is who: name -> email pairs learned from the chat and from extracted events.
+# The directory itself is a dict-like store (a CachedDict of the channel store), keyed by lowercased name with [name, email] values.
+# This code should not include any interaction with the Moobius platform.
+import re, json, functools
+
+_EMAIL_RE = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+_NAMED_EMAIL_RE = re.compile(r'@?([A-Z][\w\'-]*(?:\s+[A-Z][\w\'-]*)*)\s*[(<]\s*([\w.+-]+@[\w-]+(?:\.[\w-]+)+)\s*[)>]') # "Alice Smith (alice@x.com)" or "Alice <alice@x.com>"
+_MENTION_RE = re.compile(r'@([A-Z][\w\'-]*(?:\s+[A-Z][\w\'-]*)?)') # "@Michael Brown"
+
+
+@functools.lru_cache(maxsize=4096)
+def valid_email(email):
+    """Is it a valid email address? Cached, since the same addresses are checked over and over."""
+    from pydantic import EmailStr # Only imported when needed.
+    try:
+        EmailStr._validate(email) # pip install pydantic[email]
+        return True
+    except Exception:
+        return False
+
+
+def learn(directory, name, email):
+    """Adds or updates a name -> email pair. Returns True if it was new information."""
+    if not name or not email or not valid_email(email):
+        return False
+    ky = name.strip().lower()
+    if directory.get(ky) == [name.strip(), email]:
+        return False
+    directory[ky] = [name.strip(), email]
+    return True
+
+
+def learn_from_message(directory, sender_name, txt):
+    """
+    Learns from one chat message: "Name (email)" and "Name <email>" give that name's email.
+    A bare email goes to the sender only if it looks like theirs (i.e. sjohnson@... for Sarah Johnson).
+    """
+    named = _NAMED_EMAIL_RE.findall(txt)
+    for name, email in named:
+        learn(directory, name, email)
+    named_emails = set([e for _, e in named])
+    bare = [e for e in _EMAIL_RE.findall(txt) if e not in named_emails]
+    if len(bare) == 1 and _looks_like(bare[0], sender_name):
+        learn(directory, sender_name, bare[0])
+
+
+def learn_from_event(directory, event):
+    """Learns the participants (with valid emails) of an event returned by gpt.get_calendar_event."""
+    for p in event.get('participants', []):
+        learn(directory, p['name'], p.get('email'))
+
+
+def names_in_window(message_names, message_contents):
+    """The names of the people in a message window: the senders and the @mentioned."""
+    names = []
+    for name, txt in zip(message_names, message_contents):
+        for n in [name]+_MENTION_RE.findall(txt):
+            if n not in names:
+                names.append(n)
+    return names
+
+
+def resolve_participants(directory, message_names, message_contents):
+    """
+    The participants of a message window, in the JSON format of OpenAIClient.extract_participants, if everyone
+    (see names_in_window) is in the directory. None if anyone is unknown, since then the AI is needed.
+    Known people who are named without an @ are included too.
+    """
+    names = names_in_window(message_names, message_contents)
+    if not names or any(n.strip().lower() not in directory for n in names):
+        return None
+    all_txt = '\n'.join(message_contents).lower()
+    for ky in directory.keys():
+        if ky not in [n.lower() for n in names] and re.search(r'\b'+re.escape(ky)+r'\b', all_txt):
+            names.append(directory[ky][0])
+    people = [directory[n.strip().lower()] for n in names]
+    return json.dumps({'participants':[{'name':p[0], 'email':p[1]} for p in people]})
+
+
+def fill_in_emails(directory, event):
+    """Fills in the emails the extraction missed (i.e. 'unknown_email') from the directory. Modifies and returns the event."""
+    for p in event.get('participants', []):
+        known = directory.get(p['name'].strip().lower())
+        if known and not valid_email(p.get('email') or ''):
+            p['email'] = known[1]
+    return event
+
+
+def _looks_like(email, name):
+    """Does the email's user part contain a part of the name (or its initials)?"""
+    user = email.split('@')[0].lower()
+    parts = [x.lower() for x in re.findall(r'\w+', name or '')]
+    initials = ''.join([x[0] for x in parts])
+    return any(len(x) >= 3 and x in user for x in parts) or (len(initials) >= 2 and user.startswith(initials))
@@ -0,0 +1,109 @@
+# Per-channel store of extracted events, with a sorted-array interval index for overlap and free/busy queries.
+# This code should not include any interaction with the Moobius platform.
+import bisect, uuid, io, os
+
+import gpt
+
+
+class EventStore():
+    """
+    The events of one channel, persisted in a dict-like store (a CachedDict of the channel store) from event id to event.
+    Index: the events sorted by start time, plus the longest duration, so that the events overlapping [t0, t1)
+    are found with a binary search over the starts in (t0-longest, t1) instead of a scan of every event.
+    """
+    def __init__(self, events):
+        """
+        Parameters:
+          events: Dict-like store of event id -> event dict. Loaded into the index here; each change is written to it.
+        """
+        self.events = events
+        self.starts = [] # Sorted start times.
+        self.ids = [] # The event ids, in the same order as self.starts.
+        self.longest = 0 # Longest event duration, in seconds.
+        self._vevents = {} # Event id -> its cached VEVENT block.
+        for event_id, event in events.items():
+            self._index(event_id, event)
+
+    def add(self, event):
+        """
+        Adds an event. If it is a duplicate of a stored event (see gpt.is_duplicate_event), that one is updated instead.
+        Returns [event_id, conflicts]: conflicts are the other stored events that overlap it in time.
+        """
+        overlapping = self.overlaps(event['start_time'], event['end_time'])
+        dups = [eid for eid in overlapping if gpt.is_duplicate_event(event, self.events[eid])]
+        if dups:
+            event_id = dups[0]
+            self.remove(event_id)
+        else:
+            event_id = uuid.uuid4().hex
+        self.events[event_id] = event
+        self._index(event_id, event)
+        return event_id, [self.events[eid] for eid in overlapping if eid != event_id]
+
+    def remove(self, event_id):
+        event = self.events.pop(event_id)
+        i = bisect.bisect_left(self.starts, event['start_time'])
+        while self.ids[i] != event_id: # Several events can start at the same time.
+            i += 1
+        del self.starts[i]
+        del self.ids[i]
+        self._vevents.pop(event_id, None)
+
+    def overlaps(self, t0, t1):
+        """List of the ids of the events that overlap the time range [t0, t1), by start time."""
+        lo = bisect.bisect_right(self.starts, t0-self.longest)
+        hi = bisect.bisect_left(self.starts, t1)
+        return [self.ids[i] for i in range(lo, hi) if self.events[self.ids[i]]['end_time'] > t0]
+
+    def free_busy(self, t0, t1):
+        """[busy, free] within [t0, t1): each a list of [start, end] Unix time intervals, busy ones merged where events overlap."""
+        busy = []
+        for eid in self.overlaps(t0, t1):
+            e = self.events[eid]
+            start, end = max(t0, e['start_time']), min(t1, e['end_time'])
+            if busy and start <= busy[-1][1]:
+                busy[-1][1] = max(busy[-1][1], end)
+            else:
+                busy.append([start, end])
+        free = []
+        t = t0
+        for start, end in busy:
+            if start > t:
+                free.append([t, start])
+            t = end
+        if t < t1:
+            free.append([t, t1])
+        return busy, free
+
+    def vevents(self):
+        """Generator of the VEVENT blocks of all events, by start time. Only events added or changed since they were last exported are serialized."""
+        for eid in list(self.ids): # A copy, since this may run in a thread while events are added.
+            if eid not in self._vevents:
+                event = self.events.get(eid)
+                if event is None: # Removed meanwhile.
+                    continue
+                self._vevents[eid] = gpt.event_to_vevent(event, eid)
+            yield self._vevents[eid]
+
+    def to_ics(self):
+        """The whole calendar as an ICS string."""
+        file_obj = io.StringIO(newline='')
+        gpt.write_ics(self.vevents(), file_obj)
+        return file_obj.getvalue()
+
+    def write_ics(self, filename):
+        """Streams the calendar into an ICS file (replacing it once complete). Returns how many events were written. Blocking, so run it in a thread."""
+        tmp_filename = filename+'.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8', newline='') as file_obj:
+            n = gpt.write_ics(self.vevents(), file_obj)
+        os.replace(tmp_filename, filename)
+        return n
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _index(self, event_id, event):
+        i = bisect.bisect_right(self.starts, event['start_time'])
+        self.starts.insert(i, event['start_time'])
+        self.ids.insert(i, event_id)
+        self.longest = max(self.longest, event['end_time']-event['start_time'])
@@ -1,41 +1,111 @@
 # Open AI integration.
 
-import requests, io
+import io, time, asyncio, re, hashlib
 import json
-from pydantic import BaseModel, EmailStr, ValidationError
-from openai import AsyncOpenAI
 from datetime import datetime
-import os
-import ics # pip install ics
-from dateutil import parser
 import pytz
 from typing import List, Dict
+from loguru import logger
+
+import llm_transport, llm_ledger, timeparse, contacts
+
+end_time_stats = {'ai_calls':0, 'ai_calls_skipped':0} # Three-call extraction: how often the end time came from the rules in timeparse instead of the AI.
+participant_stats = {'ai_calls':0, 'ai_calls_skipped':0} # Three-call extraction: how often the participants came from the contact directory instead of the AI.
 
 
 ################ Main functions ####################
 
-async def get_calendar_event(message_names, message_contents, timezone='America/Los_Angeles'):
-    """Uses AI to get a Dict event from a list of message names and contents (these two lists must be 1:1)."""
+async def get_calendar_event(message_names, message_contents, timezone='America/Los_Angeles', one_call=True, directory=None):
+    """
+    Uses AI to get a Dict event from a list of message names and contents (these two lists must be 1:1).
+    one_call=True gets everything in a single AI call, falling back to the three separate calls (run concurrently) if that fails.
+    directory=None: The channel's contact directory (see contacts.py). If everyone in the messages is in it, the three-call
+      extraction skips the participants call. Either way it fills in the emails the AI did not find.
+    """
     client = OpenAIClient(timezone=timezone)
     description = '\n\n'.join([name+': '+txt for name, txt in zip(message_names, message_contents)])
 
-    parsed_event = await client.parse_event_description(description) # These are the three calls to the AI
-    extracted_participants_raw = await client.extract_participants(description)
+    if one_call:
+        try:
+            parsed_event, extracted_participants_raw, end_time_str = await client.extract_event(description)
+        except Exception as e: # Only the AI call (or its parsing) falls back; a bad date (i.e. no event) would be just as bad in three calls.
+            logger.warning(f'Single-call event extraction failed, falling back to three calls: {e}')
+        else:
+            return _finish_event(parsed_event, extracted_participants_raw, end_time_str, timezone, description, directory)
+
+    ask_end_time = not timeparse.has_end_hint(description) # Plain ranges and durations are read by the rules instead.
+    extracted_participants_raw = contacts.resolve_participants(directory, message_names, message_contents) if directory is not None else None
+    ask_participants = extracted_participants_raw is None
+    participant_stats['ai_calls' if ask_participants else 'ai_calls_skipped'] += 1
+    results = await asyncio.gather(client.parse_event_description(description), # These are the three calls to the AI
+                                   *([client.extract_participants(description)] if ask_participants else []),
+                                   *([client.extract_event_end_time(description)] if ask_end_time else []))
+    parsed_event = results[0]
+    if ask_participants:
+        extracted_participants_raw = results[1]
     #print("EXTRACTED EVENT:", parsed_event, "EXTRA PARTICIPANTS:", extracted_participants_raw)
-    end_time_str = await client.extract_event_end_time(description)
-
-    start_time_str = parsed_event['when'] # No such function: client.extract_event_start_time(description)
-
-    parsed_event['start_time'] = standardize_time(start_time_str, timezone)
-    parsed_event['end_time'] = parsed_event['start_time']+3600 if end_time_str == 'unknown' else standardize_time(end_time_str, timezone)
-    del parsed_event['when']
-
-    emails, extracted_participants_no_email = process_participants(extracted_participants_raw)
-    participant_nameemails = []
-    for pname in extracted_participants_no_email+list(emails.keys()):
-        participant_nameemails.append({'name':pname, 'email': emails.get(pname, 'unknown_email')})
-    parsed_event['participants'] = participant_nameemails
-    return parsed_event
+    if ask_end_time:
+        end_time_str = results[-1]
+    elif timeparse.find_end_time(description, standardize_time(parsed_event['when'], timezone), timezone) is not None:
+        end_time_str = None # _finish_event will use the rules.
+        end_time_stats['ai_calls_skipped'] += 1
+    else: # The range did not start when the event does.
+        end_time_str = await client.extract_event_end_time(description)
+        ask_end_time = True
+    if ask_end_time:
+        end_time_stats['ai_calls'] += 1
+    return _finish_event(parsed_event, extracted_participants_raw, end_time_str, timezone, description, directory)
+
+
+async def extract_events_batch(histories, timezone='America/Los_Angeles', window=16, overlap=4, max_concurrency=4, one_call=True, directory=None):
+    """
+    Extracts the events of long chat histories, i.e. to backfill a calendar. An async generator that yields
+    [history_index, first_message_index, event] as each event is extracted, skipping duplicates of events already yielded.
+
+    Parameters:
+      histories: List of [message_names, message_contents], such as the message logs of several channels.
+      timezone='America/Los_Angeles': The timezone of the chats.
+      window=16: How many messages each extraction sees.
+      overlap=4: How many messages consecutive windows share, so that an event discussed across a window boundary is still found.
+      max_concurrency=4: The most extractions running at once.
+      one_call=True, directory=None: Passed to get_calendar_event.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async def _extract(h_ix, first, names, txts):
+        async with semaphore:
+            try:
+                return h_ix, first, await get_calendar_event(names, txts, timezone=timezone, one_call=one_call, directory=directory)
+            except ValueError: # No date/time to parse, i.e. the window does not discuss an event.
+                return h_ix, first, None
+            except Exception as e:
+                logger.warning(f'Event extraction failed for history {h_ix}, messages {first}+: {e}')
+                return h_ix, first, None
+
+    tasks = []
+    for h_ix, (names, txts) in enumerate(histories):
+        for first, names0, txts0 in split_windows(names, txts, window, overlap):
+            tasks.append(asyncio.create_task(_extract(h_ix, first, names0, txts0)))
+    found = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            h_ix, first, event = await next_done
+            if event and not any(is_duplicate_event(event, other) for other in found):
+                found.append(event)
+                yield [h_ix, first, event]
+    finally:
+        for task in tasks: # I.e. the caller stopped early.
+            task.cancel()
+
+
+async def benchmark_extraction(message_names, message_contents, timezone='America/Los_Angeles', n=3):
+    """Times get_calendar_event with one_call=True and one_call=False, n times each. Returns {'one_call':[seconds], 'three_calls':[seconds]}."""
+    out = {'one_call':[], 'three_calls':[]}
+    for _ in range(n):
+        for ky, one_call in [['one_call', True], ['three_calls', False]]:
+            t0 = time.time()
+            await get_calendar_event(message_names, message_contents, timezone=timezone, one_call=one_call)
+            out[ky].append(time.time()-t0)
+    return out
 
 
 def format_event_for_humans(parsed_event):
@@ -57,23 +127,97 @@ def format_event_for_humans(parsed_event):
     return output
 
 
-def save_event_to_nylas(parsed_event, nylas_api_key, nylas_grant_id, nylas_calendar_id):
+async def save_event_to_nylas(parsed_event, nylas_api_key, nylas_grant_id, nylas_calendar_id):
     """Saves a dict calendar evt (output of get_calendar_event()) to a Nylas calendar. No OpenAI used."""
     evt, _ = format_event_for_nylas(parsed_event)
     client = NylasAPI(nylas_api_key, nylas_grant_id)
-    return client.create_event(calendar_id=nylas_calendar_id, event_data=evt)
+    return await client.create_event(calendar_id=nylas_calendar_id, event_data=evt)
+
+
+async def save_events_to_nylas(parsed_events, nylas_api_key, nylas_grant_id, nylas_calendar_id):
+    """Saves a list of dict calendar evts at once. Returns a list of responses, each with an 'error' key if it failed."""
+    evts = [format_event_for_nylas(evt)[0] for evt in parsed_events]
+    client = NylasAPI(nylas_api_key, nylas_grant_id)
+    return await client.create_events(calendar_id=nylas_calendar_id, events=evts)
 
 
 ################ Non-AI support functions ####################
 
+def _finish_event(parsed_event, extracted_participants_raw, end_time_str, timezone, description, directory=None):
+    """Converts the AI output into the event dict that get_calendar_event() returns.
+    An end_time_str of None or 'unknown' means the end time is read from the description by the rules (or is one hour after the start)."""
+    start_time_str = parsed_event['when'] # No such function: client.extract_event_start_time(description)
+
+    parsed_event['start_time'] = standardize_time(start_time_str, timezone)
+    if end_time_str is None or end_time_str == 'unknown':
+        end_time = timeparse.find_end_time(description, parsed_event['start_time'], timezone)
+        parsed_event['end_time'] = parsed_event['start_time']+3600 if end_time is None else end_time
+    else:
+        parsed_event['end_time'] = standardize_time(end_time_str, timezone)
+    del parsed_event['when']
+
+    emails, extracted_participants_no_email = process_participants(extracted_participants_raw)
+    participant_nameemails = []
+    for pname in extracted_participants_no_email+list(emails.keys()):
+        participant_nameemails.append({'name':pname, 'email': emails.get(pname, 'unknown_email')})
+    parsed_event['participants'] = participant_nameemails
+    if directory is not None:
+        contacts.fill_in_emails(directory, parsed_event)
+    return parsed_event
+
+
 def standardize_time(time_str: str, timezone: str) -> int:
-    """Non-ai natrual-language-ish time string processing. Parses it into Unix int time UTC."""
-    parsed_time = parser.parse(time_str, fuzzy=True)
-    user_tz = pytz.timezone(timezone)
-    if not hasattr(parsed_time, 'tzinfo') or not parsed_time.tzinfo:
-        parsed_time = user_tz.localize(parsed_time) # Naive times only.
-    utc_time = parsed_time.astimezone(pytz.utc)
-    return int(utc_time.timestamp())
+    """Non-ai natrual-language-ish time string processing. Parses it into Unix int time UTC. Understands "tomorrow", "next Tuesday", etc."""
+    return timeparse.parse_when(time_str, timezone)
+
+
+def _ics_time(t):
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(t))
+
+
+def _ics_escape(txt):
+    """RFC 5545 TEXT escaping."""
+    return str(txt).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def _ics_fold(line):
+    """RFC 5545 line folding: lines longer than 75 bytes continue on the next line after a space."""
+    if len(line) <= 75 and line.isascii():
+        return line
+    data = line.encode('utf-8')
+    parts = []
+    start = 0
+    limit = 75
+    while len(data)-start > limit:
+        end = start+limit
+        while data[end] & 0xC0 == 0x80: # Don't split a UTF-8 character.
+            end -= 1
+        parts.append(data[start:end])
+        start = end
+        limit = 74 # The leading space of a continuation line counts.
+    parts.append(data[start:])
+    return b'\r\n '.join(parts).decode('utf-8')
+
+
+def split_windows(message_names, message_contents, window=16, overlap=4):
+    """List of [first_message_index, names, contents] of overlapping windows that cover all the messages."""
+    step = max(1, window-overlap)
+    out = []
+    for first in range(0, max(1, len(message_names)-overlap), step):
+        out.append([first, message_names[first:first+window], message_contents[first:first+window]])
+    return [w for w in out if w[1]]
+
+
+def is_duplicate_event(event, other, max_start_gap=1800, min_title_overlap=0.5):
+    """Are they the same event? They must overlap in time (or start within max_start_gap seconds) and share enough of the words in their titles."""
+    overlap_in_time = event['start_time'] < other['end_time'] and other['start_time'] < event['end_time']
+    if not overlap_in_time and abs(event['start_time']-other['start_time']) > max_start_gap:
+        return False
+    words0 = set(re.findall(r'\w+', event['title'].lower()))
+    words1 = set(re.findall(r'\w+', other['title'].lower()))
+    if not words0 or not words1:
+        return True # Same time and no title to tell them apart.
+    return len(words0 & words1)/len(words0 | words1) >= min_title_overlap
 
 
 def process_participants(participants_json: str) -> tuple[Dict[str, str], List[str]]:
@@ -86,7 +230,7 @@ def process_participants(participants_json: str) -> tuple[Dict[str, str], List[s
         for participant in participants:
             name = participant["name"]
             email = participant.get("email")
-            if email and EmailStr._validate(email): # pip install pydantic[email]
+            if email and contacts.valid_email(email): # Invalid emails count as no email.
                 emails_dict[name] = email
             else:
                 names_without_valid_email.append(name)
@@ -125,39 +269,94 @@ def format_event_for_nylas(parsed_event: Dict) -> tuple[Dict, List[str]]:
     return event_data, excluded_members
 
 
+ICS_HEADER = 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:moobius-calendar-demo\r\n'
+ICS_FOOTER = 'END:VCALENDAR\r\n'
+
+
+def event_to_vevent(event, uid=None):
+    """
+    The VEVENT block (a str, CRLF line endings) of an event dict (output of get_calendar_event). uid=None makes one from the title and start.
+    Written directly rather than through ics.Event, which is many times slower for big exports.
+    """
+    uid = uid or hashlib.sha1(f"{event['title']}|{event['start_time']}".encode('utf-8')).hexdigest()+'@moobius-calendar-demo'
+    lines = ['BEGIN:VEVENT', 'UID:'+uid, 'DTSTAMP:'+_ics_time(time.time()),
+             'DTSTART:'+_ics_time(event['start_time']), 'DTEND:'+_ics_time(event['end_time']),
+             'SUMMARY:'+_ics_escape(event['title']), 'DESCRIPTION:'+_ics_escape(event['description']), 'LOCATION:'+_ics_escape(event['location'])]
+    for participant in event['participants']:
+        email = participant.get('email')
+        if email and email != 'unknown_email':
+            lines.append('ATTENDEE;CN="'+participant['name'].replace('"', "'")+'":mailto:'+email)
+    lines.append('END:VEVENT')
+    return '\r\n'.join([_ics_fold(line) for line in lines])
+
+
+def write_ics(vevent_blocks, file_obj):
+    """Streams VEVENT blocks (any iterable, i.e. a generator) into an ICS file object. Only one block is held at a time. Returns how many were written."""
+    file_obj.write(ICS_HEADER)
+    n = 0
+    for block in vevent_blocks:
+        file_obj.write(block+'\r\n')
+        n += 1
+    file_obj.write(ICS_FOOTER)
+    return n
+
+
+async def write_ics_async(vevent_blocks, write_f, chunk_size=65536):
+    """Like write_ics, but to an async stream: write_f is an async function that takes a str (i.e. an HTTP response body writer).
+    Blocks are sent in chunks of about chunk_size characters."""
+    chunk = [ICS_HEADER]
+    size = 0
+    for block in vevent_blocks:
+        chunk.append(block+'\r\n')
+        size += len(block)
+        if size >= chunk_size:
+            await write_f(''.join(chunk))
+            chunk = []
+            size = 0
+    chunk.append(ICS_FOOTER)
+    await write_f(''.join(chunk))
+
+
 def generate_ics_calender(events, filename=None):
-    """Save ics canender to a filename. None will save to a string instead.
-    These events are deduced from messages with get_calendar_event."""
-    calendar = ics.Calendar() # Make an empty calendar.
-
-    for event_data in events:
-        event = ics.Event()
-        event.name = event_data['title']
-        event.begin = datetime.fromtimestamp(event_data['start_time'])
-        event.end = datetime.fromtimestamp(event_data['end_time'])
-        event.description = event_data['description']
-        event.location = event_data['location']
-
-        for participant in event_data['participants']:
-            event.add_attendee(f"{participant['name']} <{participant['email']}>")
-        calendar.events.add(event)
-
-    file_obj = open(filename, 'w', encoding='utf-8') if filename else io.StringIO()
-    file_obj.writelines(calendar)
-    out = file_obj.getvalue()
-    file_obj.close()
-    if filename:
-        print(f"ICS file generated: {filename}")
-    return out
+    """Save ics canender to a filename. None will save to a string instead. Returns the string or the filename.
+    These events are deduced from messages with get_calendar_event. They are serialized one at a time as they are written."""
+    vevent_blocks = (event_to_vevent(event_data) for event_data in events)
+    if not filename:
+        file_obj = io.StringIO(newline='')
+        write_ics(vevent_blocks, file_obj)
+        return file_obj.getvalue()
+    with open(filename, 'w', encoding='utf-8', newline='') as file_obj: # newline='': the CRLFs are already there.
+        write_ics(vevent_blocks, file_obj)
+    print(f"ICS file generated: {filename}")
+    return filename
 
 
 #######################AI and Nylas APIs#############################
 
-# NylasAPI class handles interactions with the Nylas API, such as retrieving calendars and creating events
+# NylasAPI class handles interactions with the Nylas API, such as retrieving calendars and creating events.
+# All calls are async and share one pooled HTTP client, so a slow Nylas response never blocks the event loop.
+NYLAS_URL = 'https://api.us.nylas.com'
+NYLAS_TIMEOUT = {'timeout':20.0, 'connect':5.0} # Seconds.
+NYLAS_LIMITS = {'max_connections':16, 'max_keepalive_connections':8}
+_nylas_http = None
+
+
+def _get_nylas_http():
+    # The shared connection pool (an httpx.AsyncClient), made on first use.
+    global _nylas_http
+    if _nylas_http is None:
+        import httpx
+        _nylas_http = httpx.AsyncClient(timeout=httpx.Timeout(**NYLAS_TIMEOUT), limits=httpx.Limits(**NYLAS_LIMITS))
+    return _nylas_http
+
+
 class NylasAPI:
-    def __init__(self, api_key: str, grant_id: str):
+    def __init__(self, api_key: str, grant_id: str, base_url=NYLAS_URL, max_retries=3):
+        # base_url can point to a local stand-in server for testing.
         self.api_key = api_key
         self.grant_id = grant_id
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
 
     def _get_headers(self) -> Dict[str, str]:
         # Returns the necessary headers for authentication with the Nylas API
@@ -166,57 +365,116 @@ class NylasAPI:
             'Content-Type': 'application/json'
         }
 
-    def get_calendars(self) -> List[Dict]:
+    async def _request(self, method: str, path: str, params=None, json_data=None) -> Dict:
+        # Sends a request, retrying with exponential backoff (or the Retry-After header). GET is retried on connection errors,
+        # timeouts, 429 and 5xx. Other methods (i.e. POST events) only when the request never reached Nylas (connect errors
+        # and 429), since after a read timeout or a 5xx the event may have been created already, and a retry would duplicate it.
+        import httpx
+        idempotent = method in ['GET', 'HEAD']
+        not_sent_errors = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+        url = f'{self.base_url}/v3/grants/{self.grant_id}/{path}'
+        for attempt in range(self.max_retries+1):
+            try:
+                response = await _get_nylas_http().request(method, url, headers=self._get_headers(), params=params, json=json_data)
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                if attempt == self.max_retries or not (idempotent or isinstance(e, not_sent_errors)):
+                    raise e
+                delay = 0.5*2**attempt
+                logger.warning(f'Nylas {method} {path} failed ({e}), retrying in {delay} s.')
+            else:
+                retry = response.status_code == 429 or (idempotent and response.status_code >= 500)
+                if not retry or attempt == self.max_retries:
+                    return response.json()
+                try:
+                    delay = float(response.headers.get('Retry-After', 0.5*2**attempt))
+                except ValueError:
+                    delay = 0.5*2**attempt
+                logger.warning(f'Nylas {method} {path} returned {response.status_code}, retrying in {delay} s.')
+            await asyncio.sleep(min(delay, 30.0))
+
+    async def get_calendars(self) -> List[Dict]:
         # Fetches all calendars associated with the grant ID
-        url = f'https://api.us.nylas.com/v3/grants/{self.grant_id}/calendars'
-        response = requests.get(url, headers=self._get_headers())
-        return response.json()
+        return await self._request('GET', 'calendars')
 
-    def get_events(self, calendar_id: str, limit=5) -> List[Dict]:
+    async def get_events(self, calendar_id: str, limit=5) -> List[Dict]:
         # Fetches the latest events from a specific calendar
-        url = f'https://api.us.nylas.com/v3/grants/{self.grant_id}/events?calendar_id={calendar_id}&limit={limit}'
-        response = requests.get(url, headers=self._get_headers())
-        return response.json()
+        return await self._request('GET', 'events', params={'calendar_id':calendar_id, 'limit':limit})
 
-    def create_event(self, calendar_id: str, event_data: Dict) -> Dict:
+    async def create_event(self, calendar_id: str, event_data: Dict) -> Dict:
         # Creates a new event in the specified calendar
-        url = f'https://api.us.nylas.com/v3/grants/{self.grant_id}/events?calendar_id={calendar_id}'
-        response = requests.post(url, headers=self._get_headers(), data=json.dumps(event_data))
-        return response.json()
+        return await self._request('POST', 'events', params={'calendar_id':calendar_id}, json_data=event_data)
 
+    async def create_events(self, calendar_id: str, events: List[Dict], max_concurrency=4) -> List[Dict]:
+        # Creates many events, a few at a time. Returns the responses in the same order; a failure is an {'error':...} response instead of raising.
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async def _create(event_data):
+            async with semaphore:
+                try:
+                    return await self.create_event(calendar_id, event_data)
+                except Exception as e:
+                    return {'error':str(e)}
+        return await asyncio.gather(*[_create(evt) for evt in events])
 
-# CalendarEvent model for storing event details, used in parsing responses from OpenAI
-class CalendarEvent(BaseModel):
-    title: str
-    description: str
-    when: str
-    location: str
-    participants: list[str]
+
+def __getattr__(name):
+    """The pydantic models (i.e. gpt.CalendarEvent) are in ai_models.py, which is only imported on first use."""
+    if name in ['CalendarEvent', 'Participant', 'FullCalendarEvent']:
+        import ai_models
+        return getattr(ai_models, name)
+    raise AttributeError(f"module 'gpt' has no attribute '{name}'")
 
 
 # OpenAIClient class handles interactions with the OpenAI API, such as extracting event details and participants
 class OpenAIClient:
     def __init__(self, timezone: str):
-        self.client = AsyncOpenAI()
+        self.client = llm_transport.get_client() # Shared, so that calls reuse warm connections.
         self.timezone = timezone
 
     async def parse_event_description(self, description: str) -> Dict:
         """Uses GPT to convert the description into a CalendarEvent-as-dict format.
         description is a string such as John: bar,\n Joe: baz"""
+        import ai_models
         user_tz = pytz.timezone(self.timezone)
         current_time = datetime.now(user_tz).strftime("%Y-%m-%d %H:%M:%S")
         # Parses the event description to extract structured event details using OpenAI
         system_message = f"Extract the event details based on the following structure: title, description, when, location, and participants. The current date and time is {current_time}. Please ensure WHEN is a date or time description that can be converted into a standard date format. Put some details in the title. Missing parts fill with 'unknown'."
-        completion = await self.client.beta.chat.completions.parse(
+        completion = await llm_ledger.track('parse_event', "gpt-4o-mini", self.client.beta.chat.completions.parse(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": str(description)},
             ],
-            response_format=CalendarEvent
-        )
+            response_format=ai_models.CalendarEvent
+        ))
         return json.loads(completion.choices[0].message.content)
 
+    async def extract_event(self, description: str) -> tuple[Dict, str, str]:
+        """Does the work of parse_event_description, extract_participants and extract_event_end_time in one call.
+        Returns what these three would return."""
+        import ai_models
+        user_tz = pytz.timezone(self.timezone)
+        current_time = datetime.now(user_tz).strftime("%Y-%m-%d %H:%M:%S")
+        system_message = f"""Extract the event details based on the following structure: title, description, when, end, location, and participants. The current date and time is {current_time}.
+            Please ensure WHEN is a date or time description that can be converted into a standard date format. Put some details in the title.
+            END is the end time as "YYYY-MM-DD HH:MM:SS". If the end time is not explicitly mentioned, try to calculate it based on the start time and the duration mentioned. If can't get the end time, set END to 'unknown'.
+            Each participant has a name and an email. If the email is not available, set the email to null.
+            Missing parts fill with 'unknown'."""
+        completion = await llm_ledger.track('extract_event', "gpt-4o-mini", self.client.beta.chat.completions.parse(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": str(description)},
+            ],
+            response_format=ai_models.FullCalendarEvent
+        ))
+        event = completion.choices[0].message.parsed
+        if not event:
+            raise Exception('No event in the AI response: '+str(completion.choices[0].message.refusal))
+        parsed_event = {'title':event.title, 'description':event.description, 'when':event.when, 'location':event.location,
+                        'participants':[p.name for p in event.participants]}
+        participants_json = json.dumps({'participants':[{'name':p.name, 'email':p.email} for p in event.participants]})
+        return parsed_event, participants_json, event.end
+
     async def extract_participants(self, description: str) -> str:
         # Extracts participants' names and emails from the event description using OpenAI
         prompt = f"""
@@ -226,14 +484,14 @@ class OpenAIClient:
             - If the input is "Alice (alice@example.com) and Bob will attend the meeting", return {{\"participants\": [{{\"name\": \"Alice\", \"email\": \"alice@example.com\"}}, {{\"name\": \"Bob\", \"email\": null}}]}}.
         """
 
-        response = await self.client.chat.completions.create(
+        response = await llm_ledger.track('participants', "gpt-4o-mini", self.client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": prompt},
                 {"role": "user", "content": description}
             ],
             response_format={"type": "json_object"}
-        )
+        ))
         return response.choices[0].message.content
 
     async def extract_event_end_time(self, description: str) -> str:
@@ -250,29 +508,22 @@ class OpenAIClient:
             - If the input is "The meeting will last for 2 hours", and the current time is "2023-09-15 14:00:00", return {{"end_time": "2023-09-15 16:00:00"}}.
         """
 
-        response = await self.client.chat.completions.create(
+        response = await llm_ledger.track('end_time', "gpt-4o-mini", self.client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": prompt},
                 {"role": "user", "content": description}
             ],
             response_format={"type": "json_object"}
-        )
+        ))
         out = json.loads(response.choices[0].message.content)
         return out['end_time']
 
 
-def _ensure_ai_key():
-    api_key_name = 'OPENAI_API_KEY'
-    api_key_val = os.environ.get(api_key_name)
-    if not api_key_val:
-        print(f"No {api_key_name} env var set")
-        import tkinter as tk # Delayed import of tkinter in case it is a headless instance which does not have tkinter installed.
-        from tkinter import simpledialog
-        root = tk.Tk()
-        root.withdraw()
-        api_key_val = simpledialog.askstring("No open AI key found", "Enter your open AI key:").strip()
-        if not api_key_val:
-            raise Exception('Input cancelled by user.')
-        os.environ[api_key_name] = api_key_val
-_ensure_ai_key()
+if __name__ == '__main__': # Compares the latency of the single-call and the three-call extraction.
+    names = ['Sarah Johnson', 'Michael Brown', 'Sarah Johnson', 'Sarah Johnson']
+    txts = ['Are you available next week in the morning, your local time?', 'Yes, I am. What day and time do you prefer?',
+            'How about Tuesday at 9:30 AM for an hour?', 'sjohnson@vcfinvest.com']
+    times = asyncio.run(benchmark_extraction(names, txts))
+    for ky, v in times.items():
+        print(f'{ky}: mean {sum(v)/len(v):.2f} s, min {min(v):.2f} s over {len(v)} runs')
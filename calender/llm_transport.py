@@ -0,0 +1,238 @@
+# One shared, pooled OpenAI client per process, so that AI calls reuse warm keep-alive connections.
+# The same file is in each demo that talks to OpenAI (the demos are run from their own folder).
+# Several API keys (or organizations) can be pooled to get past the rate limits of one key: see KeyPool.
+# openai and httpx are slow to import, so they are imported on first use (see get_client).
+import os, sys, re, time, asyncio
+
+from loguru import logger
+
+settings = {'max_connections':16, # Most connections open at once.
+            'max_keepalive_connections':8, # Idle connections kept open for reuse.
+            'keepalive_expiry':120.0, # Seconds an idle connection is kept.
+            'connect_timeout':10.0, # Seconds; includes the TLS handshake.
+            'read_timeout':120.0, # Seconds to wait for a (long) completion.
+            'max_retries':2,
+            'warm_connections':2, # How many connections warm_up() opens.
+            'api_keys_file':None, # Optional file of pooled keys: one per line, "key" or "key organization". Keys in the OPENAI_API_KEYS env var are added.
+            'quarantine_seconds':20.0, # How long a key is skipped after a 429 without a Retry-After; doubles with each 429 in a row.
+            'max_quarantine_seconds':300.0}
+_client = None
+_pool = None
+
+
+def configure(**kwargs):
+    """Changes the settings (see above), such as from a config file. Call before the first get_client()."""
+    global _client, _pool
+    for ky, v in kwargs.items():
+        if ky not in settings:
+            raise Exception(f'Unknown llm_transport setting: {ky}')
+        settings[ky] = v
+    if _client is not None:
+        logger.warning('llm_transport.configure() called after the client was made; the new settings apply to a new client.')
+        _client = None
+    _pool = None
+
+
+def has_display():
+    """Can a GUI popup be shown? False on headless hosts (i.e. Linux servers without an X or Wayland display)."""
+    if sys.platform.startswith('win') or sys.platform == 'darwin':
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def ensure_api_key():
+    """Returns the OpenAI key. If the env var is not set, asks for it in a popup, or raises an Exception on a headless host. Call from on_start."""
+    api_key_name = 'OPENAI_API_KEY'
+    api_key_val = os.environ.get(api_key_name)
+    if not api_key_val:
+        print(f"No {api_key_name} env var set")
+        if not has_display():
+            raise Exception(f'No {api_key_name} env var set, and no display to ask for it on. Set {api_key_name} (or OPENAI_API_KEYS for a pool of keys).')
+        import tkinter as tk # Delayed import of tkinter in case it is a headless instance which does not have tkinter installed.
+        from tkinter import simpledialog
+        root = tk.Tk()
+        root.withdraw()
+        api_key_val = simpledialog.askstring("No open AI key found", "Enter your open AI key:").strip()
+        if not api_key_val:
+            raise Exception('Input cancelled by user.')
+        os.environ[api_key_name] = api_key_val
+    return api_key_val
+
+
+def load_keys():
+    """
+    The KeyPool of this process, made on the first call: the keys in settings['api_keys_file'] and the OPENAI_API_KEYS
+    env var (comma separated, "key" or "key:organization"). If there are none, the single key from ensure_api_key(). Call from on_start.
+    """
+    global _pool
+    if _pool is None:
+        keys = []
+        if settings['api_keys_file']:
+            with open(settings['api_keys_file'], 'r', encoding='utf-8') as f_obj:
+                for line in f_obj:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        keys.append(line.split()[:2])
+        for x in os.environ.get('OPENAI_API_KEYS', '').split(','):
+            if x.strip():
+                keys.append(x.strip().split(':', 1))
+        if not keys:
+            keys = [[ensure_api_key()]]
+        _pool = KeyPool([_Key(*k) for k in keys])
+        logger.info(f'{len(_pool.keys)} OpenAI key(s) in the pool.')
+    return _pool
+
+
+def get_client():
+    """
+    The AsyncOpenAI client of this process, made on the first call. Each request it sends (retries included) is
+    signed with the pooled key that has the most quota left (see KeyPool.pick), so it can be shared by every caller.
+    """
+    global _client
+    if _client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        pool = load_keys()
+        limits = httpx.Limits(max_connections=settings['max_connections'], max_keepalive_connections=settings['max_keepalive_connections'],
+                              keepalive_expiry=settings['keepalive_expiry'])
+        timeout = httpx.Timeout(settings['read_timeout'], connect=settings['connect_timeout'])
+        print("Initializing openai.AsyncOpenAI")
+        http_client = httpx.AsyncClient(limits=limits, timeout=timeout, event_hooks={'request':[pool.on_request], 'response':[pool.on_response]})
+        _client = AsyncOpenAI(api_key=pool.keys[0].api_key, max_retries=settings['max_retries'], timeout=timeout, http_client=http_client)
+    return _client
+
+
+def stats():
+    """The state of each pooled key (the key itself abbreviated), i.e. for a status message."""
+    return load_keys().stats()
+
+
+class _Key():
+    """One API key (and optional organization), with its rate-limit state as of the last response."""
+    def __init__(self, api_key, organization=None):
+        self.api_key = api_key
+        self.organization = organization
+        self.limit_requests = None # From the x-ratelimit-* response headers; None until the first response.
+        self.limit_tokens = None
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.reset_at = 0 # When the quota is back to full (the later of the request and token resets).
+        self.quarantined_until = 0
+        self.strikes = 0 # 429s in a row.
+        self.last_used = 0
+        self.sent = 0
+        self.rate_limited = 0
+
+    def quota_left(self, now):
+        """Fraction (0 to 1) of the scarcer of the request and token quotas that is left. 1 if unknown or reset since."""
+        if now >= self.reset_at:
+            return 1.0
+        fracs = [1.0]
+        if self.limit_requests and self.remaining_requests is not None:
+            fracs.append(self.remaining_requests/self.limit_requests)
+        if self.limit_tokens and self.remaining_tokens is not None:
+            fracs.append(self.remaining_tokens/self.limit_tokens)
+        return max(0.0, min(fracs))
+
+
+class KeyPool():
+    """
+    Schedules requests across API keys by the quota each has left, read from the rate-limit headers of its responses
+    and counted down between responses. A key is quarantined (skipped) for a while after a 429.
+    The on_request and on_response httpx event hooks do the work, so OpenAI's own retries go to another key too.
+    """
+    def __init__(self, keys):
+        """
+        Parameters:
+          keys: List of _Key. There must be at least one.
+        """
+        self.keys = keys
+        self.by_api_key = {k.api_key:k for k in keys}
+
+    def pick(self):
+        """The key to use next: the unquarantined key with the most quota left, the least recently used one on a tie.
+        If all are quarantined, the one released soonest."""
+        now = time.time()
+        ready = [k for k in self.keys if k.quarantined_until <= now]
+        if not ready:
+            return min(self.keys, key=lambda k: k.quarantined_until)
+        return max(ready, key=lambda k: (k.quota_left(now), -k.last_used))
+
+    async def on_request(self, request):
+        key = self.pick()
+        request.headers['Authorization'] = f'Bearer {key.api_key}'
+        if key.organization:
+            request.headers['OpenAI-Organization'] = key.organization
+        elif 'OpenAI-Organization' in request.headers:
+            del request.headers['OpenAI-Organization']
+        key.last_used = time.time()
+        key.sent += 1
+        if key.remaining_requests is not None: # Counted down until the response has the real numbers.
+            key.remaining_requests -= 1
+        if key.remaining_tokens is not None:
+            key.remaining_tokens -= len(request.content or b'')//4 # Roughly 4 bytes a token.
+
+    async def on_response(self, response):
+        key = self.by_api_key.get(response.request.headers.get('Authorization', '')[len('Bearer '):])
+        if key is None:
+            return
+        h = response.headers
+        now = time.time()
+        if 'x-ratelimit-remaining-requests' in h:
+            key.limit_requests = _to_int(h.get('x-ratelimit-limit-requests'))
+            key.limit_tokens = _to_int(h.get('x-ratelimit-limit-tokens'))
+            key.remaining_requests = _to_int(h.get('x-ratelimit-remaining-requests'))
+            key.remaining_tokens = _to_int(h.get('x-ratelimit-remaining-tokens'))
+            key.reset_at = now+max(_to_seconds(h.get('x-ratelimit-reset-requests')), _to_seconds(h.get('x-ratelimit-reset-tokens')))
+        if response.status_code == 429:
+            key.rate_limited += 1
+            if key.quarantined_until > now:
+                return # Sent before the key was quarantined; not a new strike.
+            key.strikes += 1
+            hint = _to_seconds(h.get('retry-after-ms', '')+'ms') if h.get('retry-after-ms') else _to_seconds(h.get('retry-after'))
+            wait = min(max(hint, settings['quarantine_seconds']*2**(key.strikes-1)), settings['max_quarantine_seconds'])
+            key.quarantined_until = now+wait
+            key.reset_at = max(key.reset_at, key.quarantined_until) # Out of quota until then, so it is picked last once released.
+            key.remaining_requests = 0
+            key.limit_requests = key.limit_requests or 1
+            logger.warning(f'OpenAI key ...{key.api_key[-4:]} rate limited, skipping it for {wait:.1f} s.')
+        elif response.status_code < 400:
+            key.strikes = 0
+
+    def stats(self):
+        now = time.time()
+        return [{'key':'...'+k.api_key[-4:], 'organization':k.organization, 'sent':k.sent, 'rate_limited':k.rate_limited,
+                 'quota_left':round(k.quota_left(now), 3), 'quarantined_for':max(0.0, round(k.quarantined_until-now, 1))} for k in self.keys]
+
+
+def _to_int(x):
+    try:
+        return int(x)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_seconds(x):
+    """Duration header to seconds: "20ms", "1.5s", "6m0s", or a plain number of seconds as in Retry-After. 0 if missing."""
+    if not x:
+        return 0.0
+    try:
+        return float(x)
+    except ValueError:
+        pass
+    units = {'h':3600.0, 'm':60.0, 's':1.0, 'ms':0.001}
+    return sum([float(v)*units[u] for v, u in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', x)])
+
+
+async def warm_up():
+    """
+    Makes the client and opens (settings['warm_connections']) connections with cheap requests, so the first user-facing
+    AI call skips the DNS lookup and TLS handshake. Call from on_start. Failures are logged, not raised.
+    """
+    client = get_client()
+    results = await asyncio.gather(*[client.models.list() for _ in range(settings['warm_connections'])], return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        logger.warning(f'OpenAI connection warm-up failed: {errors[0]}')
+    else:
+        logger.info(f'Warmed up {len(results)} OpenAI connection(s).')
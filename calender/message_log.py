@@ -0,0 +1,121 @@
+# Fixed-capacity log of the recent chat messages of a channel, with append-only persistence.
+# This code should not include any interaction with the Moobius platform.
+import os, json
+from collections import deque
+
+from loguru import logger
+
+
+class MessageLog():
+    """
+    The most recent [name, txt] pairs of a channel. Appending is O(1): the pair goes to an in-memory ring buffer
+    and one JSON line is appended to the log file. The file is compacted back down to the capacity
+    once it is twice the capacity, so the rewrite cost is spread over many appends.
+    A trigram index over the (lowercased) texts, updated on every append and eviction, makes find_oldest() fast.
+    """
+    def __init__(self, path, capacity=96, legacy_messages=None):
+        """
+        Parameters:
+          path: The .jsonl file to persist to, one [name, txt] JSON list per line.
+          capacity=96: How many of the most recent messages to keep.
+          legacy_messages=None: A list of [name, txt] pairs to start with if there is no file yet (i.e. the old recent_messages store).
+        """
+        self.path = path
+        self.capacity = capacity
+        self.messages = deque()
+        self.lines_in_file = 0
+        self._lower = deque() # Lowercased text of each message.
+        self._first_seq = 0 # Sequence number of self.messages[0]; each message gets the next one.
+        self._trigrams = {} # Trigram -> deque of the (ascending) sequence numbers of the messages that contain it.
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._file = None
+        needs_compact = False
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self.lines_in_file += 1
+                    try:
+                        self._add(json.loads(line))
+                    except json.JSONDecodeError: # I.e. a line cut short by a crash.
+                        logger.warning(f'Skipping unreadable line in {path}.')
+                        needs_compact = True # Don't append after a partial line.
+        elif legacy_messages:
+            for m in legacy_messages:
+                self._add(m)
+            needs_compact = True
+        if needs_compact:
+            self._compact()
+        else:
+            self._file = open(path, 'a', encoding='utf-8')
+
+    def append(self, name, txt):
+        """Adds a message, dropping the oldest if at capacity."""
+        self._add([name, txt])
+        self._file.write(json.dumps([name, txt])+'\n')
+        self._file.flush()
+        self.lines_in_file += 1
+        if self.lines_in_file >= 2*self.capacity:
+            self._compact()
+
+    def recent(self, n=None):
+        """List of the n most recent [name, txt] pairs, oldest first. None for all of them."""
+        if n is None or n >= len(self.messages):
+            return list(self.messages)
+        return [self.messages[i] for i in range(len(self.messages)-n, len(self.messages))]
+
+    def find_oldest(self, phrase):
+        """
+        Index, in recent(), of the oldest message whose text contains phrase (case-insensitive). None if there is none.
+        Only the messages that have the phrase's rarest trigram are checked.
+        """
+        phrase = phrase.lower()
+        if len(phrase) < 3: # No trigrams to look up.
+            candidates = range(self._first_seq, self._first_seq+len(self.messages))
+        else:
+            postings = [self._trigrams.get(g) for g in _trigrams_of(phrase)]
+            if not all(postings):
+                return None
+            candidates = min(postings, key=len)
+        for seq in candidates:
+            i = seq-self._first_seq
+            if phrase in self._lower[i]:
+                return i
+        return None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def _add(self, m):
+        """Adds [name, txt] to the ring buffer and the index, evicting the oldest past the capacity."""
+        seq = self._first_seq+len(self.messages)
+        txt = m[1].lower()
+        self.messages.append(m)
+        self._lower.append(txt)
+        for g in _trigrams_of(txt):
+            self._trigrams.setdefault(g, deque()).append(seq)
+        while len(self.messages) > self.capacity:
+            self.messages.popleft()
+            for g in _trigrams_of(self._lower.popleft()): # The evicted message is the oldest, so it is at the front of every posting.
+                posting = self._trigrams[g]
+                posting.popleft()
+                if not posting:
+                    del self._trigrams[g]
+            self._first_seq += 1
+
+    def _compact(self):
+        """Rewrites the file to hold only what is in the ring buffer."""
+        if self._file:
+            self._file.close()
+        tmp_path = self.path+'.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for m in self.messages:
+                f.write(json.dumps(m)+'\n')
+        os.replace(tmp_path, self.path)
+        self.lines_in_file = len(self.messages)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+
+def _trigrams_of(txt):
+    return set([txt[i:i+3] for i in range(len(txt)-2)])
@@ -0,0 +1,111 @@
+# Extracts calendar events in the background while people chat, so a button click can use the result right away.
+# This code should not include any interaction with the Moobius platform.
+import asyncio, hashlib, json, time, copy
+
+from loguru import logger
+
+import llm_ledger
+
+
+def window_key(message_names, message_contents, timezone):
+    """Hash of what the extraction depends on."""
+    return hashlib.sha1(json.dumps([timezone, message_names, message_contents]).encode('utf-8')).hexdigest()
+
+
+class EventPrefetcher():
+    """
+    Caches prefetched events by the content hash of the message window. notify() is called on each chat message;
+    after quiet_seconds without another message, the recent window is extracted in the background (at most once per
+    min_interval seconds per channel). extract() uses a prefetched or in-flight result for the same window (once), otherwise extracts it.
+    """
+    def __init__(self, extract_f, enabled=False, quiet_seconds=5.0, window=16, min_interval=60.0, max_age=1800.0, max_cached=8):
+        """
+        Parameters:
+          extract_f: Async function (channel_id, message_names, message_contents, timezone) -> event, i.e. wrapping gpt.get_calendar_event.
+          enabled=False: Whether notify() extracts in the background at all. If not, extract() always extracts.
+          quiet_seconds=5.0: How long the chat must be quiet before extracting.
+          window=16: How many recent messages to extract from; the same as the default lookback of the button.
+          min_interval=60.0: The rate cap: seconds between background extractions of a channel.
+          max_age=1800.0: Seconds before a cached event is stale (it was extracted relative to the time back then).
+          max_cached=8: Cached events per channel.
+        """
+        self.extract_f = extract_f
+        self.enabled = enabled
+        self.quiet_seconds = quiet_seconds
+        self.window = window
+        self.min_interval = min_interval
+        self.max_age = max_age
+        self.max_cached = max_cached
+        self.timers = {} # Channel id to the asyncio.Task waiting for the chat to be quiet.
+        self.last_run = {} # Channel id to the time of the last background extraction.
+        self.cache = {} # Channel id to dict from window key to [time, future of the event]. Dicts keep insertion order, oldest first.
+        self.stats = {'hits':0, 'misses':0, 'prefetched':0, 'rate_limited':0, 'errors':0}
+
+    def notify(self, channel_id, name_txt_pairs, timezone):
+        """Call on each new message with the channel's most recent (at least self.window) [name, txt] pairs."""
+        if not self.enabled:
+            return
+        timer = self.timers.get(channel_id)
+        if timer and not timer.done():
+            timer.cancel() # Restart the quiet period.
+        pairs = name_txt_pairs[-self.window:]
+        self.timers[channel_id] = asyncio.create_task(self._prefetch_when_quiet(channel_id, pairs, timezone))
+
+    async def extract(self, channel_id, message_names, message_contents, timezone):
+        """
+        The event of a message window. A prefetched event is used only once and the result of extract() is not cached,
+        so asking again extracts anew (i.e. to retry a bad extraction, or with newly learned contacts). Returns a copy, so it can be modified.
+        """
+        key = window_key(message_names, message_contents, timezone)
+        cached = self._get(channel_id, key)
+        if not cached:
+            self.stats['misses'] += 1
+            return await self.extract_f(channel_id, message_names, message_contents, timezone)
+        self.stats['hits'] += 1
+        del self.cache[channel_id][key]
+        with llm_ledger.context(channel=channel_id):
+            llm_ledger.record('extract_event', None, cache_hit=True) # So the ledger shows the calls saved.
+        return copy.deepcopy(await asyncio.shield(cached))
+
+    async def _prefetch_when_quiet(self, channel_id, pairs, timezone):
+        await asyncio.sleep(self.quiet_seconds)
+        names = [p[0] for p in pairs]
+        txts = [p[1] for p in pairs]
+        key = window_key(names, txts, timezone)
+        if self._get(channel_id, key):
+            return # Already done (or underway) for this window.
+        if time.time()-self.last_run.get(channel_id, 0) < self.min_interval:
+            self.stats['rate_limited'] += 1
+            return
+        self.last_run[channel_id] = time.time()
+        self.stats['prefetched'] += 1
+        try:
+            with llm_ledger.context(feature='prefetch'): # The extraction task inherits this.
+                task = self._start(channel_id, key, names, txts, timezone)
+            await asyncio.shield(task) # A new message cancels this wait, not the extraction.
+        except Exception as e:
+            logger.warning(f'Background event extraction failed for channel {channel_id}: {e}')
+
+    def _get(self, channel_id, key):
+        """The future of a fresh cached event, or None."""
+        x = self.cache.get(channel_id, {}).get(key)
+        if not x or time.time()-x[0] > self.max_age:
+            return None
+        if x[1].done() and (x[1].cancelled() or x[1].exception()): # Failures are not cached.
+            return None
+        return x[1]
+
+    def _start(self, channel_id, key, message_names, message_contents, timezone):
+        """Starts an extraction and caches its future right away, so that a click during a prefetch waits for it instead of repeating it."""
+        channel_cache = self.cache.setdefault(channel_id, {})
+        task = asyncio.create_task(self.extract_f(channel_id, message_names, message_contents, timezone))
+        task.add_done_callback(self._on_done)
+        channel_cache.pop(key, None)
+        channel_cache[key] = [time.time(), task]
+        while len(channel_cache) > self.max_cached:
+            del channel_cache[next(iter(channel_cache))]
+        return task
+
+    def _on_done(self, task):
+        if not task.cancelled() and task.exception():
+            self.stats['errors'] += 1
@@ -1,4 +1,6 @@
 import asyncio, pprint, os, re
+from datetime import datetime
+import pytz
 import random
 import json
 from loguru import logger
@@ -7,16 +9,23 @@ from moobius import Moobius, MoobiusStorage, MoobiusWand
 from moobius.types import Button, ButtonClick, MessageBody, InputComponent, Dialog
 from moobius import types
 
-import gpt
+import gpt, llm_transport, llm_ledger, message_log, prefetch, contacts, event_store, timeparse
 
 #####################################################################################################################
 
 class CalendarService(Moobius):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        with open('./config/client.json') as f: # Demo-specific config.
+            self.client_config = json.load(f)
+        llm_transport.configure(**self.client_config.get('llm_transport', {}))
+        llm_ledger.configure(**self.client_config.get('llm_ledger', {}))
         if not os.path.exists('debug'):
             os.makedirs('debug') # Ensure exists.
         self.channel_stores = {}
+        self.message_logs = {} # Channel id to the message_log.MessageLog of its recent chat messages.
+        self.event_stores = {} # Channel id to the event_store.EventStore of the events extracted so far.
+        self.prefetcher = prefetch.EventPrefetcher(self._extract_event, **self.client_config.get('prefetch', {})) # Caches extracted events, optionally extracting in the background.
         self.imp = None # A helper Character agent that explains what is going on. Created once per startup.
 
     async def _update_char_list(self, channel_id, who=None):
@@ -34,15 +43,23 @@ class CalendarService(Moobius):
         api_component = InputComponent(label="API Key", type=types.TEXT, required=True, placeholder="Nylas API key")
         grant_component = InputComponent(label="Grant ID", type=types.TEXT, required=True, placeholder="Nylas id")
         id_component = InputComponent(label="Calendar ID", type=types.TEXT, required=True, placeholder="Nylas calendar id")
-        history_component = InputComponent(label="Specify how many recent chat messages to include OR text snippit from the oldest message. Limit of 96.",  type=types.TEXT, required=True, placeholder="16")
+        history_component = InputComponent(label="Specify how many recent chat messages to include OR text snippit from the oldest message. Limit of "+str(self.client_config.get('message_log_capacity', 96))+".",  type=types.TEXT, required=True, placeholder="16")
         save_nylas_component = InputComponent(label="Save to your Nylas calendar?", type=types.DROPDOWN, required=False, choices=['yes', 'no'], placeholder="no")
         timezone_component = InputComponent(label="Input your group's timezone", type=types.TEXT, required=True, placeholder="America/Los_Angeles")
 
         api_button_dia = Dialog(title='Input your Nylas keys', components=[api_component, grant_component, id_component])
         history_dia = Dialog(title='GPT extraction of event in the chat', components=[history_component, save_nylas_component])
+        backfill_component = InputComponent(label="How many recent chat messages to search for events, or 'all'.", type=types.TEXT, required=True, placeholder="all")
+        backfill_dia = Dialog(title='GPT extraction of all events in the chat', components=[backfill_component, save_nylas_component])
+        from_component = InputComponent(label="From", type=types.TEXT, required=True, placeholder="today 9am")
+        to_component = InputComponent(label="To", type=types.TEXT, required=True, placeholder="today 6pm")
+        freebusy_dia = Dialog(title='When is the group free?', components=[from_component, to_component])
         timezone_dia = Dialog(title='Time zone', components=[timezone_component])
         buttons = [Button(button_id='nylas', button_text='Input Nylas info', dialog=api_button_dia),
                    Button(button_id='calendar_msg', button_text='AI extract event', dialog=history_dia),
+                   Button(button_id='backfill', button_text='AI extract all events', dialog=backfill_dia),
+                   Button(button_id='freebusy', button_text='Free/busy', dialog=freebusy_dia),
+                   Button(button_id='export_ics', button_text='Export calendar (.ics)'),
                    Button(button_id='set_timezone', button_text='Set Channel Timezone', dialog=timezone_dia),
                    Button(button_id='test', button_text='test')]
         await self.send_buttons(buttons, channel_id, [user_id])
@@ -53,12 +70,42 @@ class CalendarService(Moobius):
         if not self.imp:
             self.imp = await self.create_agent(name='helper')
         self.channel_stores[channel_id] = MoobiusStorage(self.client_id, channel_id, self.config['db_config'])
+        self.message_logs[channel_id] = message_log.MessageLog(f'json_db/message_log/{channel_id}.jsonl', capacity=self.client_config.get('message_log_capacity', 96),
+                                                               legacy_messages=self.channel_stores[channel_id].recent_messages.get('messages')) # Older versions stored the messages here.
+        self.event_stores[channel_id] = event_store.EventStore(self.channel_stores[channel_id].events)
+
+    async def _extract_event(self, channel_id, message_names, message_contents, timezone):
+        """gpt.get_calendar_event with the channel's contact directory, which learns from the result."""
+        directory = self.channel_stores[channel_id].contacts
+        with llm_ledger.context(channel=channel_id):
+            event = await gpt.get_calendar_event(message_names, message_contents, timezone=timezone, directory=directory)
+        contacts.learn_from_event(directory, event)
+        return event
+
+    def _store_event(self, channel_id, event, timezone):
+        """Adds an event to the channel's event store. Returns a warning about the events it conflicts with, or None."""
+        _, conflicts = self.event_stores[channel_id].add(event)
+        if not conflicts:
+            return None
+        return 'Warning, this conflicts with:\n'+'\n'.join([f"  {e['title']} ({self._format_time(e['start_time'], timezone)} to {self._format_time(e['end_time'], timezone)})" for e in conflicts])
+
+    def _format_time(self, t, timezone):
+        return datetime.fromtimestamp(t, pytz.timezone(timezone)).strftime('%Y-%m-%d %H:%M')
 
     async def on_start(self, *args, **kwargs):
-        pass
+        llm_transport.load_keys() # Fail (or ask for the key) now, not on the first button click.
+        asyncio.create_task(llm_transport.warm_up()) # Open the AI connections before anyone needs them.
 
     async def on_spell(self, spell):
         print("THE SPELL:", spell)
+        if type(spell) is str and spell.strip().startswith('llm_usage'): # "llm_usage [channel|feature|model|hour] [hours]" prints the top AI consumers.
+            words = spell.split()
+            by = words[1] if len(words) > 1 else 'channel'
+            if by not in ['channel', 'feature', 'model', 'hour']:
+                print('Usage: llm_usage [channel|feature|model|hour] [hours]')
+                return
+            hours = float(words[2]) if len(words) > 2 else 24
+            print(await asyncio.to_thread(llm_ledger.report, by, hours))
 
     async def on_refresh(self, action):
         await self._update_buttons(action.channel_id, action.sender)
@@ -76,15 +123,23 @@ class CalendarService(Moobius):
         store = self.channel_stores[button_click.channel_id]
         timezone = store.timezones.get('timezone', 'America/Los_Angeles')
 
-        async def _process_message_pairs(pairs, show_nylas_format=False):
+        async def _process_message_pairs(pairs, is_test=False):
+            """is_test=True is for the test button's sample chat: the contact directory does not learn from it, its event is not stored, and the Nylas JSON is shown."""
             senders = [p[0] for p in pairs]
             txts = [p[1] for p in pairs]
             try:
-                event = await gpt.get_calendar_event(senders, txts, timezone=timezone)
+                if is_test: # Not self._extract_event, so the sample's people do not go into the channel's contacts.
+                    with llm_ledger.context(channel=button_click.channel_id):
+                        event = await gpt.get_calendar_event(senders, txts, timezone=timezone, directory=store.contacts)
+                else:
+                    event = await self.prefetcher.extract(button_click.channel_id, senders, txts, timezone)
             except Exception as e:
                 await self.send_message('Error getting the calender event:\n'+str(e), button_click.channel_id, self.imp, await self.fetch_member_ids(button_click.channel_id))
                 raise e
             await self.send_message('Event description:\n'+gpt.format_event_for_humans(event), button_click.channel_id, self.imp, await self.fetch_member_ids(button_click.channel_id))
+            conflict_warning = None if is_test else self._store_event(button_click.channel_id, event, timezone) # The sample event would show in Free/busy and the export.
+            if conflict_warning:
+                await self.send_message(conflict_warning, button_click.channel_id, self.imp, await self.fetch_member_ids(button_click.channel_id))
 
             if button_click.arguments:
                 cal_save = button_click.arguments[1].value.lower() in ['yes', 'y', 'true', True] # Nylas save.
@@ -94,7 +149,7 @@ class CalendarService(Moobius):
             if cal_save:
                 api = store.user_nylas_keys.get(button_click.sender)
                 if api:
-                    response_info = gpt.save_event_to_nylas(parsed_event=event, nylas_api_key=api[0], nylas_grant_id=api[1], nylas_calendar_id=api[2])
+                    response_info = await gpt.save_event_to_nylas(parsed_event=event, nylas_api_key=api[0], nylas_grant_id=api[1], nylas_calendar_id=api[2])
                     if response_info.get('error'):
                         msg_txt = f'Error saving to Nylas calendar {api[2]}:\n'+str(response_info['error'])
                     else:
@@ -102,7 +157,7 @@ class CalendarService(Moobius):
                     await self.send_message(msg_txt, button_click.channel_id, self.imp, button_click.sender)
                 else:
                     await self.send_message('No Nylas API keys given to save it to, can paste in this JSON instead:\n'+json.dumps(event1, indent=2), button_click.channel_id, self.imp, button_click.sender)
-            if show_nylas_format:
+            if is_test:
                 await self.send_message('Debug Nylas JSON:\n'+json.dumps(event1, indent=2)+(' \n\nExcluded these members from the Nylas due to no email:\n'+str(excluded) if excluded else ''), button_click.channel_id, self.imp, button_click.sender)
 
         if the_id == 'nylas':
@@ -112,22 +167,75 @@ class CalendarService(Moobius):
             store.user_nylas_keys[button_click.sender] = [api, grant, cal]
             await self.send_message('Nylas credentials saved!', button_click.channel_id, self.imp, [button_click.sender])
         elif the_id == 'calendar_msg':
-            name_txt_pairs = store.recent_messages.get('messages', [])
+            the_log = self.message_logs[button_click.channel_id]
             lookback = button_click.arguments[0].value.lower() # 3 means will include three messages.
-            N = len(name_txt_pairs)
+            N = len(the_log)
             if re.search('[a-zA-Z]', lookback): # Search the message history for this message.
-                for i in range(N):
-                    if lookback.lower() in name_txt_pairs[i][1].lower():
-                        lookback = N-i
-                        break
+                i = the_log.find_oldest(lookback)
+                if i is not None:
+                    lookback = N-i
                 else:
                     await self.send_message('The lookback given was message text to search for and was not found. Using a default value of 12 instead.', button_click.channel_id, self.imp, button_click.sender)
                     lookback = 12
             else:
                 lookback = int(lookback) # Intepret as int.
             lookback = min(lookback, N)
-            name_txt_pairs0 = name_txt_pairs[-lookback:]; senders = [p[0] for p in name_txt_pairs0]; txts = [p[1] for p in name_txt_pairs0]
+            name_txt_pairs0 = the_log.recent(lookback); senders = [p[0] for p in name_txt_pairs0]; txts = [p[1] for p in name_txt_pairs0]
             await _process_message_pairs(name_txt_pairs0)
+        elif the_id == 'backfill':
+            the_log = self.message_logs[button_click.channel_id]
+            how_many = button_click.arguments[0].value.strip().lower()
+            if how_many in ['', 'all']:
+                how_many = None
+            elif how_many.isdigit() and int(how_many) > 0:
+                how_many = int(how_many)
+            else:
+                await self.send_message(f"Could not read how many messages to search: {how_many}. Give a number, or 'all'.", button_click.channel_id, self.imp, button_click.sender)
+                return
+            pairs = the_log.recent(how_many)
+            cal_save = button_click.arguments[1].value.lower() in ['yes', 'y', 'true', True]
+            api = store.user_nylas_keys.get(button_click.sender)
+            everyone = await self.fetch_member_ids(button_click.channel_id)
+            await self.send_message(f'Searching {len(pairs)} messages for events...', button_click.channel_id, self.imp, everyone)
+            events = []
+            directory = store.contacts
+            with llm_ledger.context(channel=button_click.channel_id, feature='backfill'):
+                async for _, first, event in gpt.extract_events_batch([[[p[0] for p in pairs], [p[1] for p in pairs]]], timezone=timezone, directory=directory, **self.client_config.get('backfill', {})):
+                    contacts.learn_from_event(directory, event)
+                    events.append(event)
+                    conflict_warning = self._store_event(button_click.channel_id, event, timezone)
+                    await self.send_message(f'Event found (from message {first+1} of {len(pairs)}):\n'+gpt.format_event_for_humans(event)+('\n\n'+conflict_warning if conflict_warning else ''), button_click.channel_id, self.imp, everyone)
+            msg_txt = f'Done, found {len(events)} events.'
+            if cal_save and events:
+                if api:
+                    responses = await gpt.save_events_to_nylas(events, nylas_api_key=api[0], nylas_grant_id=api[1], nylas_calendar_id=api[2])
+                    errors = [r['error'] for r in responses if r.get('error')]
+                    msg_txt += f' Saved {len(events)-len(errors)} of them to Nylas calendar: '+api[2]+(('\nErrors:\n'+'\n'.join([str(e) for e in errors])) if errors else '')
+                else:
+                    msg_txt += ' No Nylas API keys given to save them to.'
+            await self.send_message(msg_txt, button_click.channel_id, self.imp, button_click.sender)
+        elif the_id == 'freebusy':
+            try:
+                t0 = timeparse.parse_when(button_click.arguments[0].value, timezone)
+                t1 = timeparse.parse_when(button_click.arguments[1].value, timezone)
+            except (ValueError, OverflowError) as e:
+                await self.send_message('Could not read the times: '+str(e), button_click.channel_id, self.imp, button_click.sender)
+                return
+            busy, free = self.event_stores[button_click.channel_id].free_busy(t0, t1)
+            lines = [f'From {self._format_time(t0, timezone)} to {self._format_time(t1, timezone)} ({timezone}):']
+            lines += ['Busy:']+[f'  {self._format_time(a, timezone)} to {self._format_time(b, timezone)}' for a, b in busy] if busy else ['No events.']
+            lines += ['Free:']+[f'  {self._format_time(a, timezone)} to {self._format_time(b, timezone)}' for a, b in free] if free else ['No free time.']
+            await self.send_message('\n'.join(lines), button_click.channel_id, self.imp, button_click.sender)
+        elif the_id == 'export_ics':
+            the_store = self.event_stores[button_click.channel_id]
+            if not len(the_store):
+                await self.send_message('No events yet, use "AI extract event" first.', button_click.channel_id, self.imp, button_click.sender)
+                return
+            os.makedirs('json_db/exports', exist_ok=True)
+            filename = f'json_db/exports/{button_click.channel_id}.ics'
+            n = await asyncio.to_thread(the_store.write_ics, filename) # Streams to disk without holding up other channels.
+            await self.send_message(filename, button_click.channel_id, self.imp, [button_click.sender], subtype=types.FILE, file_display_name='calendar.ics')
+            await self.send_message(f'Exported {n} events.', button_click.channel_id, self.imp, button_click.sender)
         elif the_id == 'set_timezone':
             timezone = button_click.arguments[0].value
             store.timezones['timezone'] = timezone
@@ -146,21 +254,23 @@ class CalendarService(Moobius):
             test_pairs.append(['Baker Smith', "I would also like to join!"])
             test_pairs.append(['Sarah Johnson', "sjohnson@vcfinvest.com"])
             await self.send_message("Testing with this data:\n"+'\n'.join([str(p) for p in test_pairs]), button_click.channel_id, button_click.sender, [button_click.sender])
-            await _process_message_pairs(test_pairs, True)
+            await _process_message_pairs(test_pairs, is_test=True)
+            stats = gpt.end_time_stats
+            await self.send_message(f"End-time AI calls skipped by the time rules (three-call extraction only): {stats['ai_calls_skipped']} of {stats['ai_calls_skipped']+stats['ai_calls']}", button_click.channel_id, self.imp, button_click.sender)
+            stats = gpt.participant_stats
+            await self.send_message(f"Participant AI calls skipped by the contact directory (three-call extraction only): {stats['ai_calls_skipped']} of {stats['ai_calls_skipped']+stats['ai_calls']}", button_click.channel_id, self.imp, button_click.sender)
         else:
             await self.send_message('Unrecognized button: '+the_id, button_click.channel_id, self.imp, [button_click.sender])
 
     async def on_message_up(self, message_up: MessageBody):
         """Add to the history if it is a text message."""
         if message_up.subtype == types.TEXT:
-            message_history = self.channel_stores[message_up.channel_id].recent_messages.get('messages')
-            if not message_history:
-                message_history = []
             sender_name =  (await self.fetch_character_profile(message_up.sender)).name
-            message_history.append([sender_name, message_up.content.text]) # Name text pairs.
-            while len(message_history) > 96: # Limit the length.
-                message_history = message_history[1:]
-            self.channel_stores[message_up.channel_id].recent_messages['messages'] = message_history
+            the_log = self.message_logs[message_up.channel_id]
+            the_log.append(sender_name, message_up.content.text) # Name text pairs, the oldest are dropped past the capacity.
+            contacts.learn_from_message(self.channel_stores[message_up.channel_id].contacts, sender_name, message_up.content.text)
+            timezone = self.channel_stores[message_up.channel_id].timezones.get('timezone', 'America/Los_Angeles')
+            self.prefetcher.notify(message_up.channel_id, the_log.recent(self.prefetcher.window), timezone)
         all_but_the_sender = [r for r in message_up.recipients if r != message_up.sender]
         await self.send_message(message_up, recipients=all_but_the_sender)
 
@@ -0,0 +1,147 @@
+# Rule-based reading of time expressions in chat text: time ranges ("3pm to 4pm"), durations ("for 2 hours"),
+# weekdays ("next Tuesday") and relative dates ("tomorrow"). Used to skip AI calls when the text is plain enough. No AI in here.
+import re, functools
+from datetime import datetime, timedelta, time
+
+import pytz
+
+_NUMBER_WORDS = {'a':1, 'an':1, 'one':1, 'two':2, 'three':3, 'four':4, 'five':5, 'six':6, 'seven':7, 'eight':8, 'ten':10,
+                 'half an':0.5, 'half a':0.5}
+_NUMBER = r'(\d+(?:\.\d+)?|half an?|an?|one|two|three|four|five|six|seven|eight|ten)'
+_UNIT = r'(hours?|hrs?|minutes?|mins?)'
+_TIME = r'(\d{1,2})(?::(\d{2}))?\s*([ap]\.?m\.?)?'
+_WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+_RANGE_RE = re.compile(r'\b(?:from\s+)?'+_TIME+r'\s*(?:-|–|to|until|till)\s*'+_TIME+r'(?![\d:])', re.I)
+# Durations of the event itself: after "for"/"lasts" or before an event noun. Not "takes" ("it takes 10 minutes to walk there").
+_DURATION_RES = [re.compile(r'\b(?:for|lasts?|lasting)\s+(?:about\s+|around\s+|roughly\s+)?'+_NUMBER+r'\s*'+_UNIT+r'\b(\s+and\s+a\s+half)?', re.I),
+                 re.compile(r'\b'+_NUMBER+r'[\s-]*'+_UNIT+r'[\s-]+(?:long\s+)?(?:meeting|call|chat|session|sync|lunch|dinner|coffee|interview|demo|talk)\b', re.I),
+                 re.compile(r'\b(half an hour|an hour and a half)\b', re.I)]
+_RELATIVE_DAY_RE = re.compile(r'\b(day after tomorrow|tomorrow|today|tonight|in\s+(\d+|a|one|two|three)\s+(days?|weeks?))\b', re.I)
+_WEEKDAY_RE = re.compile(r'\b(?:(next|this|coming)\s+)?('+'|'.join(_WEEKDAYS)+r')\b', re.I)
+
+
+def find_ranges(txt):
+    """List of (start_hour, start_minute, end_hour, end_minute), 24-hour, of each time range in the text.
+    Only ranges with an am/pm or a ":" are counted, so that "3 to 4 people" is not a range."""
+    out = []
+    for m in _RANGE_RE.finditer(txt):
+        h0, m0, ap0, h1, m1, ap1 = m.groups()
+        if not (ap0 or ap1 or m0 or m1):
+            continue
+        h0 = int(h0); h1 = int(h1)
+        if h0 > 23 or h1 > 23:
+            continue
+        ap0 = ap0.replace('.', '').lower() if ap0 else None
+        ap1 = ap1.replace('.', '').lower() if ap1 else None
+        if ap1 and not ap0: # "3 to 4pm" is 3pm, but "11 to 1pm" is 11am.
+            ap0 = ap1 if h0 <= h1 or h0 == 12 else ('am' if ap1 == 'pm' else 'pm')
+        elif ap0 and not ap1: # "11am-1" ends at 1pm.
+            ap1 = ap0 if h0 <= h1 or h0 == 12 else ('pm' if ap0 == 'am' else 'am')
+        out.append((_to_24(h0, ap0), int(m0 or 0), _to_24(h1, ap1), int(m1 or 0)))
+    return out
+
+
+def find_duration(txt):
+    """The stated duration of the event in the text, in seconds. None if there is none, or if different durations are stated (the AI decides then)."""
+    found = set()
+    for pattern in _DURATION_RES:
+        for m in pattern.finditer(txt):
+            found.add(_to_seconds(m.groups()))
+    if len(found) != 1:
+        return None
+    return found.pop()
+
+
+def has_end_hint(txt):
+    """Is there a time range or duration that find_end_time may be able to use?"""
+    return bool(find_ranges(txt)) or find_duration(txt) is not None
+
+
+def find_end_time(txt, start_time, timezone):
+    """
+    Unix end time of an event from the text, given its Unix start time. None if the rules can't tell.
+    A time range counts only if it starts when the event starts; otherwise the last stated duration is used.
+    """
+    return _find_end_time(txt, start_time, timezone)
+
+
+@functools.lru_cache(maxsize=1024)
+def _find_end_time(txt, start_time, timezone):
+    user_tz = pytz.timezone(timezone)
+    start_local = datetime.fromtimestamp(start_time, user_tz)
+    for h0, m0, h1, m1 in reversed(find_ranges(txt)):
+        if (h0, m0) == (start_local.hour, start_local.minute):
+            end_naive = start_local.replace(tzinfo=None, hour=h1, minute=m1, second=0)
+            if end_naive <= start_local.replace(tzinfo=None):
+                end_naive += timedelta(days=1) # "10pm to 1am"
+            return int(user_tz.localize(end_naive).timestamp())
+    duration = find_duration(txt)
+    if duration:
+        return start_time+duration
+    return None
+
+
+def resolve_day(txt, today):
+    """The date a relative day or weekday in the text refers to (the last one mentioned), given today's date. None if there is none."""
+    found = [(m.start(), 'relative', m) for m in _RELATIVE_DAY_RE.finditer(txt)]+[(m.start(), 'weekday', m) for m in _WEEKDAY_RE.finditer(txt)]
+    if not found:
+        return None
+    _, kind, m = max(found, key=lambda x: x[0])
+    if kind == 'weekday':
+        delta = (_WEEKDAYS.index(m.group(2).lower())-today.weekday()) % 7
+        if delta == 0 and m.group(1) and m.group(1).lower() == 'next':
+            delta = 7
+        return today+timedelta(days=delta)
+    phrase = m.group(1).lower()
+    if phrase == 'day after tomorrow':
+        return today+timedelta(days=2)
+    if phrase == 'tomorrow':
+        return today+timedelta(days=1)
+    if phrase in ['today', 'tonight']:
+        return today
+    n = m.group(2).lower()
+    n = _NUMBER_WORDS.get(n) or int(n)
+    return today+timedelta(days=n*(7 if m.group(3).lower().startswith('week') else 1))
+
+
+def parse_when(time_str, timezone):
+    """Natural-language-ish time string to Unix int time (UTC). Like dateutil's fuzzy parsing, but relative days
+    such as "tomorrow" and "next Tuesday" are understood. Memoized per timezone (and day, since it depends on today)."""
+    return _parse_when(time_str, timezone, datetime.now(pytz.timezone(timezone)).date())
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_when(time_str, timezone, today):
+    from dateutil import parser # Slow to import, so only imported when needed.
+    user_tz = pytz.timezone(timezone)
+    day = resolve_day(time_str, today)
+    if day:
+        rest = _WEEKDAY_RE.sub(' ', _RELATIVE_DAY_RE.sub(' ', time_str))
+        try:
+            parsed_time = parser.parse(rest, fuzzy=True, default=datetime.combine(day, time(0)))
+        except (ValueError, OverflowError): # Nothing but the day, i.e. "tomorrow".
+            parsed_time = datetime.combine(day, time(0))
+    else:
+        parsed_time = parser.parse(time_str, fuzzy=True)
+    if not parsed_time.tzinfo:
+        parsed_time = user_tz.localize(parsed_time) # Naive times only.
+    return int(parsed_time.astimezone(pytz.utc).timestamp())
+
+
+def _to_seconds(groups):
+    if len(groups) == 1: # "half an hour" and "an hour and a half".
+        return 1800 if groups[0].lower() == 'half an hour' else 5400
+    number = groups[0].lower()
+    amount = _NUMBER_WORDS[number] if number in _NUMBER_WORDS else float(number)
+    if len(groups) > 2 and groups[2]: # "... and a half"
+        amount += 0.5
+    return int(amount*(3600 if groups[1].lower().startswith('h') else 60))
+
+
+def _to_24(hour, ampm):
+    if ampm == 'pm' and hour < 12:
+        return hour+12
+    if ampm == 'am' and hour == 12:
+        return 0
+    return hour
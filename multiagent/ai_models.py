@@ -0,0 +1,19 @@
+# Pydantic models for structured AI output. Separate from gpt.py so that pydantic is only imported when one is used.
+from pydantic import BaseModel
+
+
+class Person(BaseModel):
+    name: str
+    personality: str
+class Persons(BaseModel):
+    persons: list[Person]
+class Place(BaseModel):
+    name: str
+    description: str
+class Places(BaseModel):
+    places: list[Place]
+class Summary(BaseModel):
+    id: int
+    summary: str
+class Summaries(BaseModel):
+    summaries: list[Summary]
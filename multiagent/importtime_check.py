@@ -0,0 +1,56 @@
+# Import-time regression check: imports the modules that service.py imports in a fresh interpreter with "-X importtime",
+# prints the slowest imports, and fails if a heavy module is imported eagerly or the total is over budget.
+# Run from this folder: python importtime_check.py [budget_seconds]
+import subprocess, sys, os
+
+MODULES = ['gpt', 'worldbuilder', 'shards', 'lanes', 'outbox'] # Ours; service.py also imports moobius, which is not counted.
+HEAVY = ['openai', 'pydantic', 'httpx', 'ics', 'dateutil', 'tkinter'] # Must only be imported on first use.
+BUDGET = 0.5 # Seconds, for all of MODULES together (not counting what moobius and loguru import).
+
+
+def import_times(modules):
+    """
+    [times, imported] from a fresh interpreter. times: dict from top-level name to cumulative import time in seconds.
+    imported: set of the packages imported at any depth (i.e. pydantic imported by one of ours).
+    """
+    code = 'import loguru, pytz; '+'; '.join(['import '+m for m in modules]) # loguru and pytz are imported by the SDK anyway.
+    baseline, _ = _run('import loguru, pytz')
+    times, imported = _run(code)
+    return {name:us/1e6 for name, us in times.items() if name not in baseline}, imported
+
+
+def _run(code):
+    env = dict(os.environ)
+    env.pop('OPENAI_API_KEY', None) # Importing must not need the key.
+    env.pop('DISPLAY', None); env.pop('WAYLAND_DISPLAY', None) # ...or a display.
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise Exception(f'Import failed: {result.stderr[-2000:]}')
+    times = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name[1:].rstrip()
+        imported.add(name.strip().split('.')[0])
+        if name == name.lstrip(): # Only the top level (nested imports are indented further).
+            top = name.split('.')[0]
+            times[top] = times.get(top, 0)+int(cumulative)
+    return times, imported
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET
+    times, imported = import_times(MODULES)
+    total = sum(times.values())
+    print(f'Importing {", ".join(MODULES)}: {total:.3f} s')
+    for name, t in sorted(times.items(), key=lambda x: -x[1])[:12]:
+        print(f'  {t:8.4f} s  {name}')
+    eager = [h for h in HEAVY if h in imported]
+    if eager:
+        print(f'FAIL: imported eagerly: {", ".join(eager)}')
+    if total > budget:
+        print(f'FAIL: over the budget of {budget} s')
+    sys.exit(1 if eager or total > budget else 0)
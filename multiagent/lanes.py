@@ -0,0 +1,84 @@
+# Priority lanes for work that competes for the same AI capacity. This code should not include any interaction with the Moobius platform.
+import asyncio, time, heapq, contextlib
+from collections import deque
+
+HUMAN, AI, BACKGROUND = 0, 1, 2 # Lanes: human-triggered steps and commands, the AI conversation loop, memory consolidation.
+LANE_NAMES = {HUMAN:'human', AI:'ai', BACKGROUND:'background'}
+
+
+class LaneScheduler():
+    """
+    Admits work one slot at a time, by lane. Waiting work in a lower-numbered lane is admitted first,
+    so a human's step goes ahead of queued AI-loop steps and consolidation.
+    Starvation protection: work that waited max_wait seconds is admitted next whatever its lane.
+    """
+    def __init__(self, capacity=2, max_wait=15.0):
+        """
+        Parameters:
+          capacity=2: How much work can run at once.
+          max_wait=15.0: The longest (in seconds) anything waits behind higher-priority lanes.
+        """
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self.running = 0
+        self.waiting = [] # Heap of [lane, seq, t0, future].
+        self._seq = 0
+        self.waits = {lane:deque(maxlen=512) for lane in LANE_NAMES.keys()} # Recent admission waits (seconds) per lane.
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane):
+        """Use as "async with lanes.slot(lanes.HUMAN):" around the work."""
+        await self._acquire(lane)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def wait_percentile(self, lane, pct=95):
+        """The pct-th percentile of the recent admission waits of a lane, in seconds."""
+        waits = sorted(self.waits[lane])
+        if not waits:
+            return 0.0
+        return waits[min(len(waits)-1, int(len(waits)*pct/100.0))]
+
+    def report(self, pct=95):
+        """One line of the pct-th percentile admission wait of each lane, i.e. to print."""
+        return ', '.join([f'{LANE_NAMES[lane]} p{pct} wait {self.wait_percentile(lane, pct):.2f} s (last {len(self.waits[lane])})' for lane in LANE_NAMES.keys()])
+
+    async def _acquire(self, lane):
+        t0 = time.time()
+        if self.running < self.capacity and not self.waiting:
+            self.running += 1
+            self.waits[lane].append(0.0)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        entry = [lane, self._seq, t0, fut]
+        self._seq += 1
+        heapq.heappush(self.waiting, entry)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled(): # Was admitted just as it was cancelled.
+                self._release()
+            elif entry in self.waiting:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+            raise
+        self.waits[lane].append(time.time()-t0)
+
+    def _release(self):
+        self.running -= 1
+        self._admit()
+
+    def _admit(self):
+        while self.running < self.capacity and self.waiting:
+            now = time.time()
+            overdue = [e for e in self.waiting if now-e[2] >= self.max_wait]
+            if overdue:
+                entry = min(overdue, key=lambda e: e[2])
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+            else:
+                entry = heapq.heappop(self.waiting)
+            self.running += 1
+            entry[3].set_result(None)
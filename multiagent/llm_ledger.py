@@ -0,0 +1,190 @@
+# Ledger of every AI call: model, tokens in/out, cached tokens, latency and cost, by channel and feature.
+# Calls are appended to a local JSONL file (one line each), which every process of the demo (i.e. shard workers) appends to.
+# Rollups by hour, channel, feature and model are folded in from the file as it grows (see rollups()).
+# The same file is in each demo that talks to OpenAI (the demos are run from their own folder).
+import os, json, time, contextlib, contextvars, threading
+
+from loguru import logger
+
+settings = {'path':'json_db/llm_ledger.jsonl',
+            'prices':{'gpt-4o-mini':[0.15, 0.075, 0.60], # USD per million tokens: [input, cached input, output]. Matched by prefix, longest first.
+                      'gpt-4o':[2.50, 1.25, 10.00],
+                      'gpt-4-turbo':[10.00, 10.00, 30.00]}}
+
+_channel = contextvars.ContextVar('llm_ledger_channel', default=None)
+_feature = contextvars.ContextVar('llm_ledger_feature', default=None)
+_file = None
+_file_lock = threading.Lock()
+_rollup_lock = threading.Lock() # Separate, so that a slow rollups() in a thread does not hold up record().
+
+
+def configure(**kwargs):
+    """Changes the settings (see above), such as from a config file."""
+    global _file
+    for ky, v in kwargs.items():
+        if ky not in settings:
+            raise Exception(f'Unknown llm_ledger setting: {ky}')
+        settings[ky] = v
+    with _file_lock:
+        if _file:
+            _file.close()
+            _file = None
+    with _rollup_lock:
+        _rollups.reset()
+
+
+@contextlib.contextmanager
+def context(channel=None, feature=None):
+    """
+    Attributes the AI calls made within (including in tasks started within) to a channel and/or feature.
+    A feature set here prefixes the call type given to track(), i.e. "backfill/extract_event".
+    """
+    tokens = []
+    if channel is not None:
+        tokens.append((_channel, _channel.set(channel)))
+    if feature is not None:
+        tokens.append((_feature, _feature.set(feature)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def get_context():
+    """The current [channel, feature], i.e. to pass to another process."""
+    return [_channel.get(), _feature.get()]
+
+
+def set_context(channel=None, feature=None):
+    """Sets the context of the current task for good, i.e. in another process running on behalf of a channel."""
+    _channel.set(channel)
+    _feature.set(feature)
+
+
+async def track(call_type, model, coro):
+    """
+    Awaits an OpenAI call and records it. Returns (or raises) what the call does.
+
+    Parameters:
+      call_type: What the call is for, i.e. 'npc_speech' or 'extract_event'.
+      model: The model asked for; the response's model name is recorded if there is one.
+      coro: The coroutine of the call, i.e. client.chat.completions.create(...).
+    """
+    t0 = time.time()
+    try:
+        out = await coro
+    except Exception as e:
+        record(call_type, model, latency=time.time()-t0, error=type(e).__name__)
+        raise
+    usage = getattr(out, 'usage', None)
+    details = getattr(usage, 'prompt_tokens_details', None)
+    record(call_type, getattr(out, 'model', None) or model, tokens_in=getattr(usage, 'prompt_tokens', 0) or 0,
+           tokens_out=getattr(usage, 'completion_tokens', 0) or 0, cached_tokens=getattr(details, 'cached_tokens', 0) or 0,
+           latency=time.time()-t0)
+    return out
+
+
+def record(call_type, model, tokens_in=0, tokens_out=0, cached_tokens=0, latency=0.0, error=None, cache_hit=False):
+    """Appends one call to the ledger. cache_hit=True is for a result served from our own cache instead of a call (no tokens). Never raises."""
+    global _file
+    feature = _feature.get()
+    x = {'t':round(time.time(), 3), 'channel':_channel.get(), 'feature':f'{feature}/{call_type}' if feature else call_type,
+         'model':model, 'in':tokens_in, 'out':tokens_out, 'cached':cached_tokens, 'latency':round(latency, 3),
+         'cost':cost(model, tokens_in, tokens_out, cached_tokens)}
+    if error:
+        x['error'] = error
+    if cache_hit:
+        x['cache_hit'] = True
+    try:
+        with _file_lock:
+            if _file is None:
+                os.makedirs(os.path.dirname(settings['path']) or '.', exist_ok=True)
+                _file = open(settings['path'], 'a', encoding='utf-8')
+            _file.write(json.dumps(x)+'\n') # One write per line, so that lines from several processes do not interleave.
+            _file.flush()
+    except Exception as e:
+        logger.warning(f'Could not write to the AI call ledger: {e}')
+
+
+def cost(model, tokens_in, tokens_out, cached_tokens=0):
+    """Cost of a call in USD, from settings['prices']. 0 for an unknown model."""
+    for name in sorted(settings['prices'].keys(), key=len, reverse=True):
+        if model and model.startswith(name):
+            p_in, p_cached, p_out = settings['prices'][name]
+            return round(((tokens_in-cached_tokens)*p_in+cached_tokens*p_cached+tokens_out*p_out)/1e6, 8)
+    return 0.0
+
+
+class _Rollups():
+    """Totals by (hour, channel, feature, model), folded in from the ledger file from where the last fold stopped."""
+    FIELDS = ['calls', 'in', 'out', 'cached', 'latency', 'cost', 'errors', 'cache_hits']
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.totals = {} # (hour start, channel, feature, model) -> list of the FIELDS.
+        self.offset = 0 # Bytes of the file folded in so far.
+
+    def update(self):
+        path = settings['path']
+        if not os.path.exists(path):
+            return
+        if os.path.getsize(path) < self.offset: # Replaced by a new file.
+            self.reset()
+        with open(path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break # Still being written; folded in next time.
+                self.offset += len(line)
+                try:
+                    x = json.loads(line)
+                except ValueError:
+                    continue
+                ky = (int(x['t']//3600*3600), x.get('channel'), x.get('feature'), x.get('model'))
+                tot = self.totals.setdefault(ky, [0]*len(self.FIELDS))
+                for i, v in enumerate([1, x.get('in', 0), x.get('out', 0), x.get('cached', 0), x.get('latency', 0.0),
+                                       x.get('cost', 0.0), 1 if x.get('error') else 0, 1 if x.get('cache_hit') else 0]):
+                    tot[i] += v
+
+
+_rollups = _Rollups()
+
+
+def rollups(by='channel', hours=24):
+    """
+    Dict from channel, feature, model or hour (the Unix time it starts) to a dict of totals over the last hours:
+    calls, in, out, cached (tokens), latency (seconds, summed), cost (USD), errors and cache_hits. Reads the ledger file, so it may block.
+    """
+    ix = {'hour':0, 'channel':1, 'feature':2, 'model':3}[by]
+    t0 = time.time()-hours*3600
+    out = {}
+    with _rollup_lock:
+        _rollups.update()
+        for ky, tot in _rollups.totals.items():
+            if ky[0]+3600 <= t0:
+                continue
+            agg = out.setdefault(ky[ix], [0]*len(_Rollups.FIELDS))
+            for i, v in enumerate(tot):
+                agg[i] += v
+    return {ky:dict(zip(_Rollups.FIELDS, v)) for ky, v in out.items()}
+
+
+def report(by='channel', hours=24, n=10):
+    """Text table of the top n consumers (by cost, then tokens) over the last hours, i.e. to print."""
+    rolled = rollups(by, hours)
+    if by == 'hour':
+        rows = sorted(rolled.items(), reverse=True)[:n]
+    else:
+        rows = sorted(rolled.items(), key=lambda x: (-x[1]['cost'], -(x[1]['in']+x[1]['out'])))[:n]
+    lines = [f'Top AI consumers by {by}, last {hours} h:']
+    for ky, v in rows:
+        name = time.strftime('%Y-%m-%d %H:00', time.localtime(ky)) if by == 'hour' else str(ky)
+        calls = v['calls']-v['cache_hits']
+        lines.append(f"  {name}: ${v['cost']:.4f}, {calls} calls, {v['in']} in ({v['cached']} cached) / {v['out']} out tokens, "
+                     f"{v['latency']/max(calls, 1):.2f} s avg, {v['errors']} errors, {v['cache_hits']} cache hits")
+    if not rows:
+        lines.append('  No AI calls.')
+    return '\n'.join(lines)
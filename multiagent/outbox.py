@@ -0,0 +1,59 @@
+# Ordered outbound message queues. This code should not include any interaction with the Moobius platform (the send function is passed in).
+import asyncio
+from collections import deque
+
+from loguru import logger
+
+
+class Outbox():
+    """
+    One queue of outbound messages per channel.
+    The messages of a channel are sent one at a time and in order, and the total number of sends in flight is bounded.
+    A transient message (such as '<thinking>') is dropped if a later message from the same sender is queued before it went out.
+    """
+    def __init__(self, send_f, max_in_flight=4, max_queued=256):
+        """
+        Parameters:
+          send_f: Async function (channel_id, txt, sender, recipients) that sends one message.
+          max_in_flight=4: The most messages being sent at once, over all channels.
+          max_queued=256: The most messages queued per channel. Past this the oldest (transient first) are dropped.
+        """
+        self.send_f = send_f
+        self.max_queued = max_queued
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.queues = {} # Channel id to a deque of [txt, sender, recipients, transient].
+        self.workers = {} # Channel id to the asyncio.Task that empties the queue.
+        self.stats = {'sent':0, 'coalesced':0, 'dropped':0, 'errors':0} # Running totals since startup.
+        self.recent_errors = deque(maxlen=32) # [channel_id, txt, exception] of the most recent failed sends.
+
+    def put(self, channel_id, txt, sender, recipients, transient=False):
+        """Queues a message. Not async, so it can be called from the send_message_f of step_world."""
+        q = self.queues.setdefault(channel_id, deque())
+        superseded = [m for m in q if m[3] and m[1] == sender]
+        for m in superseded:
+            q.remove(m)
+        self.stats['coalesced'] += len(superseded)
+        while len(q) >= self.max_queued:
+            victims = [m for m in q if m[3]] or [q[0]]
+            q.remove(victims[0])
+            self.stats['dropped'] += 1
+            logger.warning(f'Outbox for channel {channel_id} is full, dropped: {victims[0][0][0:64]}')
+        q.append([txt, sender, recipients, transient])
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self._worker(channel_id))
+
+    async def _worker(self, channel_id):
+        q = self.queues[channel_id]
+        try:
+            while q:
+                txt, sender, recipients, _ = q.popleft()
+                async with self.in_flight:
+                    try:
+                        await self.send_f(channel_id, txt, sender, recipients)
+                        self.stats['sent'] += 1
+                    except Exception as e:
+                        self.stats['errors'] += 1
+                        self.recent_errors.append([channel_id, txt, e])
+                        logger.error(f'Failed to send message to channel {channel_id}: {e}')
+        finally:
+            del self.workers[channel_id]
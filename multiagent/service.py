@@ -1,4 +1,4 @@
-import asyncio, pprint, os
+import asyncio, pprint, os, copy
 import random
 import json
 from loguru import logger
@@ -7,7 +7,7 @@ from moobius import Moobius, MoobiusStorage, MoobiusWand
 from moobius.types import Button, ButtonClick, MessageBody, InputComponent, Dialog
 from moobius import types
 
-import worldbuilder, gpt, avatar_maker
+import worldbuilder, gpt, avatar_maker, outbox, lanes, shards, llm_transport, llm_ledger
 
 #####################################################################################################################
 
@@ -24,12 +24,30 @@ async def chunked_gather(tasks, n=4):
 class NPCService(Moobius):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        with open('./config/client.json') as f: # Demo-specific config.
+            self.client_config = json.load(f)
+        llm_transport.configure(**self.client_config.get('llm_transport', {}))
+        llm_ledger.configure(**self.client_config.get('llm_ledger', {}))
         if not os.path.exists('debug'):
             os.makedirs('debug') # Ensure exists.
         self.channel_stores = {} # Channel storages persistent to disk: world, reAct_mode, real_user_locations (id-keyed)
         self.npcs = {} # Dict from name to Character object, created once per startup or world update.
         self.imp = None # A helper Character agent that explains what is going on. Created once per startup.
         self.convo_active = {} # Is a conversation "world" active on each channel? It is reset to False every startup.
+        self.consolidation_tasks = {} # Background memory consolidation asyncio.Task, at most one per channel.
+        self.location_recipients = {} # Channel id to dict from location to the set of user ids there (kept up to date incrementally).
+        self.outbox = outbox.Outbox(self._send_outbox_message) # Ordered, per-channel queue for the messages sent during AI steps.
+        self.lanes = {} # Channel id to its lanes.LaneScheduler, see channel_lanes(). (Not self.scheduler, which Moobius uses.)
+        self.sharded_worlds = {} # Channel id to the shards.ShardedWorld that runs its world, if num_shards in client.json is nonzero.
+
+    def channel_lanes(self, channel_id):
+        """
+        The lanes.LaneScheduler of a channel, made with the "lanes" settings in client.json on first use.
+        It gates the work that makes AI calls: human-triggered work is admitted ahead of the AI loop and consolidation.
+        """
+        if channel_id not in self.lanes:
+            self.lanes[channel_id] = lanes.LaneScheduler(**self.client_config.get('lanes', {}))
+        return self.lanes[channel_id]
 
     ################################# Updating each person's view to agree with that the world is ####################
 
@@ -88,6 +106,38 @@ class NPCService(Moobius):
                    Button(button_id='travel', button_text=f'Travel (at {player_is_here})', dialog=travel_button_dia)]
         await self.send_buttons(buttons, channel_id, [user_id])
 
+    ################################# Who hears what ####################
+
+    async def _build_location_recipients(self, channel_id):
+        """Makes sure the location -> users dict of a channel exists. Only built from scratch once; _move_recipient keeps it up to date."""
+        if channel_id not in self.location_recipients:
+            where = self.channel_stores[channel_id].real_user_locations
+            by_loc = {}
+            for user_id in await self.fetch_member_ids(channel_id, False):
+                by_loc.setdefault(where.get(user_id, 'all'), set()).add(user_id)
+            self.location_recipients[channel_id] = by_loc
+        return self.location_recipients[channel_id]
+
+    def _move_recipient(self, channel_id, user_id, to_here):
+        """Moves a user to another location in the location -> users dict. None removes the user."""
+        by_loc = self.location_recipients.get(channel_id)
+        if by_loc is None:
+            return # Not built yet.
+        for users in by_loc.values():
+            users.discard(user_id)
+        if to_here:
+            by_loc.setdefault(to_here, set()).add(user_id)
+
+    async def _send_outbox_message(self, channel_id, txt, sender, recipients):
+        await self.send_message(txt, channel_id=channel_id, sender=sender, recipients=recipients)
+
+    def recipients_at(self, channel_id, location):
+        """The users that can hear something said at a location: those in the location and those who are everywhere ('all')."""
+        by_loc = self.location_recipients.get(channel_id, {})
+        if not location or location == 'all':
+            return list(set().union(*by_loc.values()))
+        return list(by_loc.get(location, set()) | by_loc.get('all', set()))
+
     ################################# Getting the buttons to agree with the npcs ####################
 
     def get_world(self, channel_id):
@@ -96,11 +146,30 @@ class NPCService(Moobius):
             return worldbuilder.from_dict(self.channel_stores[channel_id].world_dict)
         return worldbuilder.MMOWorld() # Default.
 
-    async def update_to_world(self, channel_id, world):
-        """Sets the world of a channel id, updating locations etc. Can be used to reset everything, etc."""
+    def save_world(self, channel_id, world, consolidation=False):
+        """
+        Saves the world of a channel id to the disk, without updating what the users see.
+        Compare-and-merge: if the stored world was saved by someone else (i.e. a concurrent step) since this world was loaded,
+        the changes of both are merged instead of this world overwriting them. Returns the world that was saved.
+        consolidation=True: The only change is consolidated memories, which lose to memories cleared meanwhile.
+        """
+        world_dict = self.channel_stores[channel_id].world_dict
+        stored_version = world_dict.get('version', 0)
+        if world.base is not None and stored_version != world.base.get('version', 0):
+            logger.info(f'World of channel {channel_id} changed while a step was running, merging.')
+            world = worldbuilder.merge_worlds(worldbuilder.from_dict(world.base), world, worldbuilder.from_dict(world_dict), ours_consolidated=consolidation)
+        world.version = stored_version+1
         world.compat()
         for ky, v in world.to_dict().items(): # Key by key, so that it saves the CachedDict object properly.
-            self.channel_stores[channel_id].world_dict[ky] = v
+            world_dict[ky] = copy.deepcopy(v) # A copy so that the stored dict stays a snapshot that later merges can use as a base.
+        world.base = dict(world_dict)
+        return world
+
+    async def update_to_world(self, channel_id, world):
+        """Sets the world of a channel id, updating locations etc. Can be used to reset everything, etc."""
+        world = self.save_world(channel_id, world)
+        if channel_id in self.sharded_worlds:
+            await self.sharded_worlds[channel_id].load(world)
         who_to_update_to = await self.fetch_member_ids(channel_id, False)
         await chunked_gather([self._update_buttons(channel_id, who) for who in who_to_update_to])
         await self._update_char_list(channel_id, who_to_update_to)
@@ -110,14 +179,47 @@ class NPCService(Moobius):
             self.imp = await self.create_agent(name='Imp')
         self.channel_stores[channel_id] = MoobiusStorage(self.client_id, channel_id, self.config['db_config'])
         self.convo_active[channel_id] = False
-        await self.update_to_world(channel_id, self.get_world(channel_id))
+        world = self.get_world(channel_id)
+        num_shards = self.client_config.get('num_shards', 0)
+        if num_shards > 0 and channel_id not in self.sharded_worlds:
+            sharded = shards.ShardedWorld(num_shards, f'json_db/shards/{channel_id}')
+            world = await sharded.start(world) # The workers' own saves are newer than the stored world.
+            self.sharded_worlds[channel_id] = sharded
+        await self.update_to_world(channel_id, world)
+
+    async def sync_world(self, channel_id):
+        """Saves the world the shard workers are running (if the channel is sharded), so that get_world() is up to date. Call before reading or editing memories."""
+        if channel_id in self.sharded_worlds:
+            world = await self.sharded_worlds[channel_id].snapshot()
+            self.save_world(channel_id, world) # No base, so it overwrites; the workers have the latest of everything.
 
     def get_memory(self, channel_id, npc_name):
         """Returns the memory of a given AI. Older memories generally get more and more abbreviated."""
         world = self.get_world(channel_id)
         if npc_name not in world.people:
             return ['This person does not exist in the world.']
-        return world.people_memories.get(npc_name, [])
+        return world.memory_texts(npc_name)
+
+    def schedule_consolidation(self, channel_id, send_message_f=None):
+        """Starts consolidating the channel's memories in the background, unless that is already happening."""
+        task = self.consolidation_tasks.get(channel_id)
+        if task and not task.done():
+            return # The running task will pick up the new memories.
+        with llm_ledger.context(feature='consolidation'): # The task inherits the ledger context (and the channel of the step).
+            self.consolidation_tasks[channel_id] = asyncio.create_task(self._consolidation_loop(channel_id, send_message_f))
+
+    async def _consolidation_loop(self, channel_id, send_message_f):
+        """Consolidates until no unconsolidated memories remain. Steps taken meanwhile see the raw memories."""
+        try:
+            while True:
+                world = self.get_world(channel_id)
+                async with self.channel_lanes(channel_id).slot(lanes.BACKGROUND):
+                    names = await world.consolidate_memories(send_message_f)
+                if not names:
+                    break
+                self.save_world(channel_id, world, consolidation=True) # Memories added by steps that ran meanwhile are merged in after the consolidated ones.
+        except Exception as e:
+            logger.error(f'Memory consolidation failed for channel {channel_id}: {e}')
 
     async def step_conversation(self, channel_id, speaker_id=None, txt=None):
         """
@@ -136,24 +238,53 @@ class NPCService(Moobius):
         else:
             location = None
 
-        world = self.get_world(channel_id)
-
-        real_ids = await self.fetch_member_ids(channel_id)
-        def _send_message_f(speaker_name, txt):
+        await self._build_location_recipients(channel_id)
+        def _send_message_f(speaker_name, txt, location=None, transient=False):
+            recipients = self.recipients_at(channel_id, location)
+            if not recipients:
+                return # Nobody is there to hear it.
             if speaker_name:
                 speaker_id = self.npcs[speaker_name].character_id
             else:
                 speaker_id = self.imp.character_id
-            loop = asyncio.get_event_loop()
-            loop.create_task(self.send_message(txt, channel_id=channel_id, sender=speaker_id, recipients=real_ids))
-        await world.step_world(speaker_name=speaker_name, location=location, txt=txt, is_reAct=is_reAct, send_message_f=_send_message_f)
+            self.outbox.put(channel_id, txt, speaker_id, recipients, transient=transient)
+        human_locations = [loc for loc, users in self.location_recipients[channel_id].items() if users]
+        if channel_id in self.sharded_worlds: # The workers save their part and consolidate; only the routing table is stored here.
+            sharded = self.sharded_worlds[channel_id]
+            moved = await sharded.step(speaker_name=speaker_name, location=location, txt=txt, is_reAct=is_reAct, human_locations=human_locations, send_message_f=_send_message_f)
+            self.channel_stores[channel_id].world_dict['people_where'] = dict(sharded.people_where)
+            if moved:
+                await self._update_char_list(channel_id)
+            return
+        world = self.get_world(channel_id)
+        await world.step_world(speaker_name=speaker_name, location=location, txt=txt, is_reAct=is_reAct, send_message_f=_send_message_f, consolidate=False, human_locations=human_locations)
         await self.update_to_world(channel_id, world)
+        self.schedule_consolidation(channel_id, _send_message_f) # The reply has been sent, summarize in the background.
 
     async def on_start(self, *args, **kwargs):
+        llm_transport.load_keys() # Fail (or ask for the key) now, not on the first AI step.
+        asyncio.create_task(llm_transport.warm_up()) # Open the AI connections before anyone needs them.
         asyncio.create_task(self.ai_loop())
 
     async def on_spell(self, spell):
         print("THE SPELL:", spell)
+        if type(spell) is str and spell.strip().startswith('llm_usage'): # "llm_usage [channel|feature|model|hour] [hours]" prints the top AI consumers, then what saved or lost calls and messages.
+            words = spell.split()
+            by = words[1] if len(words) > 1 else 'channel'
+            if by not in ['channel', 'feature', 'model', 'hour']:
+                print('Usage: llm_usage [channel|feature|model|hour] [hours]')
+                return
+            hours = float(words[2]) if len(words) > 2 else 24
+            print(await asyncio.to_thread(llm_ledger.report, by, hours))
+            print(f'Memory dedup: {worldbuilder.dedup_stats}, summary packing: {worldbuilder.summary_packer.stats} (this process; shard workers log theirs when consolidating).')
+            print(f'Outbox: {self.outbox.stats}')
+            for channel_id, txt, e in self.outbox.recent_errors:
+                print(f'  Failed to send to {channel_id}: {txt[0:64]}: {e}')
+        elif type(spell) is str and spell.strip() == 'lane_waits': # Prints how long the work of each channel waited for its lane.
+            for channel_id, scheduler in self.lanes.items():
+                print(f'{channel_id}: {scheduler.report()}')
+            if not self.lanes:
+                print('No lanes used yet.')
 
     async def on_refresh(self, action):
         await self._update_buttons(action.channel_id, action.sender)
@@ -163,19 +294,24 @@ class NPCService(Moobius):
         while True:
             for channel_id, is_active in self.convo_active.items():
                 if is_active: # Schedule another AI response.
-                    await self.step_conversation(channel_id, speaker_id=None, txt=None)
+                    async with self.channel_lanes(channel_id).slot(lanes.AI):
+                        with llm_ledger.context(channel=channel_id):
+                            await self.step_conversation(channel_id, speaker_id=None, txt=None)
             await asyncio.sleep(0.25)
 
     async def on_join_channel(self, action):
+        self._move_recipient(action.channel_id, action.sender, self.channel_stores[action.channel_id].real_user_locations.get(action.sender, 'all'))
         await self._update_char_list(action.channel_id)
 
     async def on_leave_channel(self, action):
+        self._move_recipient(action.channel_id, action.sender, None)
         await self._update_char_list(action.channel_id)
 
     async def on_button_click(self, button_click: ButtonClick):
+        llm_ledger.set_context(channel=button_click.channel_id) # AI calls made for this click (and tasks it starts) count for its channel.
         if button_click.button_id == 'hi':
             await self.send_message("I am thinking...", button_click.channel_id, self.npcs['Alice'].character_id, [button_click.sender])
-            txt = await gpt.gpt_get_answer([{'role':'user', 'content':'I say hi to you!', 'user_id':button_click.sender}])
+            txt = await gpt.gpt_get_answer([{'role':'user', 'content':'I say hi to you!', 'user_id':button_click.sender}], call_type='hi_button')
             await self.send_message(txt, button_click.channel_id, self.npcs['Alice'].character_id, [button_click.sender])
         elif button_click.button_id == 'startpause':
             self.convo_active[button_click.channel_id] = self.convo_active.get(button_click.channel_id, False)
@@ -207,8 +343,10 @@ Reset: Reset to the default world and people.
 '''.strip()
             await self.send_message(msg, button_click.channel_id, self.imp, [button_click.sender])
         elif button_click.button_id == 'step':
-            await self.step_conversation(button_click.channel_id, speaker_id=None, txt=None)
+            async with self.channel_lanes(button_click.channel_id).slot(lanes.HUMAN):
+                await self.step_conversation(button_click.channel_id, speaker_id=None, txt=None)
         elif button_click.button_id == 'list_memories':
+            await self.sync_world(button_click.channel_id)
             world = self.get_world(button_click.channel_id)
             for name, char in self.npcs.items():
                 if name not in world.people:
@@ -222,6 +360,7 @@ Reset: Reset to the default world and people.
                 await self.send_message(msg, button_click.channel_id, char, [button_click.sender])
         elif button_click.button_id == 'clear_memories':
             await self.send_message('You cast Obliviate on everyone and they forget everything', button_click.channel_id, button_click.sender, [button_click.sender])
+            await self.sync_world(button_click.channel_id)
             world = self.get_world(button_click.channel_id)
             world.people_memories = {}
             await self.update_to_world(button_click.channel_id, world)
@@ -231,6 +370,7 @@ Reset: Reset to the default world and people.
             to_here = button_click.arguments[0].value
             #name = (await self.fetch_character_profile(button_click.sender)).name
             self.channel_stores[button_click.channel_id].real_user_locations[button_click.sender] = to_here
+            self._move_recipient(button_click.channel_id, button_click.sender, to_here)
             if to_here == 'all':
                 msg = 'You cast a clone spell and are everywhere at once. Everyone can hear you speak.'
             else:
@@ -240,10 +380,12 @@ Reset: Reset to the default world and people.
 
     async def on_message_up(self, message_up: MessageBody):
         """Add to the history if it is a text message."""
+        llm_ledger.set_context(channel=message_up.channel_id) # AI calls made for this message (and tasks it starts) count for its channel.
         if message_up.subtype == types.TEXT:
             #print("GOT MESSAGE for:", message_up.recipients, 'IMP ID is:', self.imp.character_id)
             if len(message_up.recipients) == 1 and message_up.recipients[0] == self.imp.character_id: # Edit world messages.
                 users = await self.fetch_member_ids(message_up.channel_id)
+                await self.sync_world(message_up.channel_id)
                 txt = message_up.content.text.strip()
                 prompts = {'people':'people', 'places':'places',
                            'prompt people':'prompt-people', 'prompt-people':'prompt-people', 'prompt_people':'prompt-people',
@@ -282,14 +424,16 @@ Reset: Reset to the default world and people.
                         setattr(world, attr, x)
                         await self.update_to_world(message_up.channel_id, world)
                 if the_prompt == 'prompt-people':
-                    persons = await gpt.gpt_make_people(txt_body, temperature=0.5, model="gpt-4o-mini", num_default=8)
+                    async with self.channel_lanes(message_up.channel_id).slot(lanes.HUMAN):
+                        persons = await gpt.gpt_make_people(txt_body, temperature=0.5, model="gpt-4o-mini", num_default=8)
                     world = self.get_world(message_up.channel_id)
                     world.people = persons
                     world.people_memories = {}
                     await self.update_to_world(message_up.channel_id, world)
                     await self.send_message(message_up, text='The AI created these people:\n'+str(world.people), recipients=users)
                 elif the_prompt == 'prompt-places':
-                    places = await gpt.gpt_make_places(txt_body, temperature=0.5, model="gpt-4o-mini", num_default=6)
+                    async with self.channel_lanes(message_up.channel_id).slot(lanes.HUMAN):
+                        places = await gpt.gpt_make_places(txt_body, temperature=0.5, model="gpt-4o-mini", num_default=6)
                     world = self.get_world(message_up.channel_id)
                     world.locations = places
                     #world.people_memories = {} # Let them keep old memories from the places.
@@ -302,7 +446,7 @@ Reset: Reset to the default world and people.
 
                 if the_prompt:
                     await self.send_message(message_up, text='Command finished: '+str(the_prompt), recipients=users)
-            else:
+            else: # Not gated by a lane: a human's speech is only recorded, no AI call is made for it.
                 await self.step_conversation(message_up.channel_id, speaker_id=message_up.sender, txt=message_up.content.text)
         else:
             await self.send_message(message_up)
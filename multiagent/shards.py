@@ -0,0 +1,295 @@
+# Runs one MMOWorld split over worker processes, each running the people in some of the locations.
+# This code should not include any interaction with the Moobius platform.
+#
+# Protocol (dicts sent over a multiprocessing Pipe):
+#   Service -> worker:
+#     {'op':'load', 'id', 'index', 'world', 'shard_of', 'path'}: Replace the worker's part of the world. shard_of is the location -> shard index dict.
+#     {'op':'step', 'id', 'kwargs', 'ledger_context', 'keep_history'}: MMOWorld.step_world on the worker's part.
+#       keep_history=False leaves the speech out of the speaker_history, so speech at 'all' (sent to every worker) is recorded once.
+#     {'op':'adopt', 'person'}: A person (see MMOWorld.export_person) moved in from another shard.
+#     {'op':'snapshot', 'id'}: Send back the worker's part of the world.
+#     {'op':'stop'}
+#   Worker -> service:
+#     {'op':'message', 'args'}: A send_message_f(name, txt, location, transient) call, as it happens.
+#     {'op':'handoff', 'person', 'to'}: A person moved to a location of shard "to". Always sent before the 'done' of the step.
+#     {'op':'done', 'id', 'error', ...}: The reply to a load, step or snapshot.
+import asyncio, multiprocessing, threading, itertools, json, os
+
+from loguru import logger
+import worldbuilder, llm_ledger, llm_transport
+
+
+def partition_locations(locations, num_shards):
+    """Dict from location name to shard index, spreading the (sorted) locations round-robin."""
+    return {loc:i % num_shards for i, loc in enumerate(sorted(locations.keys()))}
+
+
+def split_world(world, shard_of, num_shards):
+    """Splits a world into num_shards world dicts. Each has every location but only the people in its own locations."""
+    world.compat()
+    parts = []
+    for i in range(num_shards):
+        part = worldbuilder.from_dict(world.to_dict())
+        for name in list(part.people.keys()):
+            if shard_of.get(part.people_where.get(name)) != i:
+                part.export_person(name)
+        part.speaker_history = [h for h in part.speaker_history if shard_of.get(h[2], 0) == i] # Speech at 'all' is kept by shard 0.
+        parts.append(part.to_dict())
+    return parts
+
+
+def join_worlds(worlds):
+    """The inverse of split_world: one world with everyone in the list of worlds. Modifies the worlds."""
+    out = worlds[0]
+    for world in worlds[1:]:
+        for name in list(world.people.keys()):
+            out.import_person(world.export_person(name))
+        out.speaker_history.extend(world.speaker_history)
+        out.version = max(out.version, world.version)
+    out.base = None
+    return out
+
+
+class ShardedWorld():
+    """
+    The service-side handle of a world run by worker processes. It only routes steps and relays messages and moves;
+    the prompts, AI calls, memory consolidation and saving happen in the workers.
+    """
+    def __init__(self, num_shards, save_dir):
+        """
+        Parameters:
+          num_shards: How many worker processes.
+          save_dir: Folder where each worker saves its part of the world after every step.
+        """
+        self.num_shards = num_shards
+        self.save_dir = save_dir
+        self.shard_of = {} # Location -> shard index.
+        self.people_where = {} # The routing table: person -> location, kept up to date from the workers' replies.
+        self.conns = []
+        self.procs = []
+        self.pending = {} # Request id -> future of the 'done' reply.
+        self.send_message_f = None # Where 'message' replies go. Set by each step.
+        self._ids = itertools.count()
+        self._skips = [0]*num_shards
+        self._last_shard = -1
+        self.loop = None
+
+    def _path(self, i):
+        return os.path.join(self.save_dir, f'shard{i}.json')
+
+    async def start(self, world):
+        """
+        Starts the worker processes. Returns the world to load into them with load(), which is the world the workers
+        saved if they saved one for the same locations (i.e. before a restart), otherwise the given world.
+        """
+        self.loop = asyncio.get_running_loop()
+        ctx = multiprocessing.get_context('spawn')
+        for i in range(self.num_shards):
+            conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+            proc.start()
+            self.conns.append(conn)
+            self.procs.append(proc)
+            threading.Thread(target=self._reader, args=(conn,), daemon=True).start()
+
+        saved = []
+        shard_of = partition_locations(world.locations, self.num_shards)
+        for i in range(self.num_shards):
+            if os.path.exists(self._path(i)):
+                with open(self._path(i), 'r', encoding='utf-8') as f:
+                    x = json.load(f)
+                if x['shard_of'] == shard_of:
+                    saved.append(worldbuilder.from_dict(x['world']))
+        if len(saved) == self.num_shards:
+            logger.info(f'Loading the {self.num_shards} shards saved in {self.save_dir}.')
+            return join_worlds(saved)
+        return world
+
+    async def load(self, world):
+        """(Re)splits the world over the workers. Used at start and after the world is edited."""
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.shard_of = partition_locations(world.locations, self.num_shards)
+        parts = split_world(world, self.shard_of, self.num_shards)
+        await asyncio.gather(*[self._call(i, {'op':'load', 'index':i, 'world':parts[i], 'shard_of':self.shard_of, 'path':self._path(i),
+                                              'ledger_settings':llm_ledger.settings, 'transport_settings':llm_transport.settings}) for i in range(self.num_shards)])
+        self.people_where = dict(world.people_where)
+
+    async def snapshot(self):
+        """The whole world, joined from the workers' parts. Slow; for showing memories and editing the world."""
+        replies = await asyncio.gather(*[self._call(i, {'op':'snapshot'}) for i in range(self.num_shards)])
+        return join_worlds([worldbuilder.from_dict(r['world']) for r in replies])
+
+    async def step(self, speaker_name=None, location=None, txt=None, is_reAct=False, human_locations=None, send_message_f=None):
+        """
+        Same as MMOWorld.step_world (with consolidate=False; the workers consolidate in the background), but run by the worker(s) of the location.
+        Speech at 'all' goes to every worker. An AI step goes to one worker, which picks the speaker among its people.
+        Returns True if anyone moved to another location.
+        """
+        self.send_message_f = send_message_f
+        if location == 'all':
+            targets = list(range(self.num_shards))
+        elif location:
+            targets = [self.shard_of.get(location, 0)]
+        else:
+            target = self._pick_shard(human_locations or [])
+            if target is None:
+                return False
+            targets = [target]
+        kwargs = {'speaker_name':speaker_name, 'location':location, 'txt':txt, 'is_reAct':is_reAct, 'human_locations':human_locations}
+        where_before = dict(self.people_where)
+        ledger_context = llm_ledger.get_context() # So the workers' AI calls count for the channel.
+        replies = await asyncio.gather(*[self._call(i, {'op':'step', 'kwargs':kwargs, 'ledger_context':ledger_context, 'keep_history':i == targets[0]}) for i in targets])
+        for r in replies:
+            self.people_where.update(r['people_where'])
+        return self.people_where != where_before
+
+    def stop(self):
+        for conn in self.conns:
+            conn.send({'op':'stop'})
+
+    def _pick_shard(self, human_locations):
+        """Which worker takes the next AI step: round-robin over the workers with people, preferring those where human users are."""
+        populated = sorted(set([self.shard_of[loc] for loc in self.people_where.values() if loc in self.shard_of]))
+        if not populated:
+            return None
+        if 'all' in human_locations:
+            seen = set(populated)
+        else:
+            seen = set([self.shard_of[loc] for loc in human_locations if loc in self.shard_of])
+        rotated = [i for i in populated if i > self._last_shard]+[i for i in populated if i <= self._last_shard]
+        tiers = [[i for i in rotated if self._skips[i] >= worldbuilder.MAX_IDLE_SKIPS],
+                 [i for i in rotated if i in seen],
+                 rotated]
+        pick = [tier for tier in tiers if tier][0][0]
+        for i in populated:
+            if i == pick:
+                self._skips[i] = 0
+            elif i not in seen:
+                self._skips[i] += 1
+        self._last_shard = pick
+        return pick
+
+    async def _call(self, i, msg):
+        msg['id'] = next(self._ids)
+        fut = self.loop.create_future()
+        self.pending[msg['id']] = fut
+        self.conns[i].send(msg)
+        return await fut
+
+    def _reader(self, conn):
+        """Runs in a thread per worker, handing the worker's replies to the event loop."""
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                msg = None
+            try:
+                if msg is None:
+                    self.loop.call_soon_threadsafe(self._on_worker_lost)
+                    break
+                self.loop.call_soon_threadsafe(self._on_reply, msg)
+            except RuntimeError: # The event loop is closed (shutting down).
+                break
+
+    def _on_worker_lost(self):
+        """A worker exited, so its replies will never come. Fails everything waiting rather than hanging."""
+        logger.error('A shard worker process exited.')
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_exception(Exception('Shard worker process exited.'))
+        self.pending = {}
+
+    def _on_reply(self, msg):
+        if msg['op'] == 'message':
+            if self.send_message_f:
+                self.send_message_f(*msg['args'])
+        elif msg['op'] == 'handoff':
+            person = msg['person']
+            self.people_where[person['name']] = person['where']
+            self.conns[msg['to']].send({'op':'adopt', 'person':person})
+        elif msg['op'] == 'done':
+            fut = self.pending.pop(msg['id'], None)
+            if not fut or fut.done():
+                return
+            if msg.get('error'):
+                fut.set_exception(Exception('Shard error: '+msg['error']))
+            else:
+                fut.set_result(msg)
+
+
+######################## Worker process #################################
+
+def _worker_main(conn):
+    asyncio.run(_worker_loop(conn))
+
+
+def _save_part(world, shard_of, path):
+    tmp_path = path+'.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'shard_of':shard_of, 'world':world.to_dict()}, f)
+    os.replace(tmp_path, path)
+
+
+async def _worker_loop(conn):
+    """Runs the worker's part of the world, one command at a time. Memories are consolidated in the background after steps, so steps do not wait for it."""
+    loop = asyncio.get_running_loop()
+    world = None
+    shard_of = {}
+    path = None
+    me = None # This worker's shard index.
+    consolidating = None # The asyncio.Task of _consolidate, if any.
+    def _send_message_f(name, txt, location=None, transient=False):
+        conn.send({'op':'message', 'args':[name, txt, location, transient]})
+
+    async def _consolidate(world):
+        try:
+            with llm_ledger.context(feature='consolidation'):
+                await world.consolidate_memories(_send_message_f)
+        except Exception as e:
+            logger.error(f'Shard {me} failed to consolidate memories: {e}')
+        _save_part(world, shard_of, path)
+
+    while True:
+        msg = await loop.run_in_executor(None, conn.recv)
+        op = msg['op']
+        reply = {'op':'done', 'id':msg.get('id')}
+        try:
+            if op == 'stop':
+                break
+            elif op == 'load':
+                if consolidating:
+                    consolidating.cancel() # Its world is being replaced.
+                world = worldbuilder.from_dict(msg['world'])
+                shard_of = msg['shard_of']
+                path = msg['path']
+                me = msg['index']
+                llm_ledger.configure(**msg['ledger_settings'])
+                if msg['transport_settings'] != llm_transport.settings: # The keys (i.e. api_keys_file), limits and timeouts from client.json. Only once, so a reload keeps the key pool's state.
+                    llm_transport.configure(**msg['transport_settings'])
+                _save_part(world, shard_of, path) # Now, so that a restart before the next step does not bring back the world this one replaced.
+            elif op == 'adopt':
+                world.import_person(msg['person'])
+                continue # No reply.
+            elif op == 'snapshot':
+                reply['world'] = world.to_dict()
+            elif op == 'step':
+                llm_ledger.set_context(*msg['ledger_context'])
+                n_history = len(world.speaker_history)
+                if world.people or msg['kwargs'].get('txt'):
+                    await world.step_world(send_message_f=_send_message_f, consolidate=False, **msg['kwargs'])
+                if not msg['keep_history']:
+                    del world.speaker_history[n_history:]
+                for name in list(world.people.keys()): # Hand off those who moved to another shard's location.
+                    i = shard_of.get(world.people_where.get(name))
+                    if i is not None and i != me:
+                        conn.send({'op':'handoff', 'person':world.export_person(name), 'to':i})
+                reply['people_where'] = dict(world.people_where)
+        except Exception as e:
+            logger.error(f'Shard {me} failed on {op}: {e}')
+            reply['error'] = str(e)
+        conn.send(reply)
+
+        if world and op == 'step':
+            _save_part(world, shard_of, path)
+            if (not consolidating or consolidating.done()) and any(world.unconsolidated.values()):
+                consolidating = asyncio.create_task(_consolidate(world)) # Runs while the next commands are received.
@@ -1,8 +1,8 @@
 # Tools for making, running, and managing a virtual world. This code should not include any interaction with the Moobius platform.
-import random, json, asyncio
+import random, json, asyncio, re, zlib, functools, copy
 
 from loguru import logger
-import gpt
+import gpt, llm_ledger
 
 ######################## Non-AI support functions #################################
 
@@ -31,6 +31,78 @@ def _assert_loc(loc, locations):
     return loc
 
 
+######################## Near-duplicate memory detection #################################
+
+DEDUP_THRESHOLD = 0.8 # Estimated Jaccard similarity at or above which a new memory counts as a repeat of one already held.
+DEDUP_LOOKBACK = 16 # How many of the most recent memories a new memory is compared against.
+dedup_stats = {'checked':0, 'dropped':0, 'llm_calls_avoided':0} # Running totals since startup.
+
+_MINHASH_PRIME = (1<<61)-1
+_MINHASH_PARAMS = [(random.Random(i).randrange(1, _MINHASH_PRIME), random.Random(-i-1).randrange(0, _MINHASH_PRIME)) for i in range(32)]
+
+
+def _shingles(txt, k=3):
+    """The set of k-word shingles of a string. Short strings become a single shingle."""
+    words = re.findall(r"\w+", txt.lower())
+    if len(words) <= k:
+        return {' '.join(words)}
+    return {' '.join(words[i:i+k]) for i in range(len(words)-k+1)}
+
+
+@functools.lru_cache(maxsize=4096)
+def minhash_signature(txt):
+    """MinHash signature (a tuple of ints) of the word shingles of txt. Cached since the same memories are checked every step."""
+    hashes = [zlib.crc32(sh.encode('utf-8')) for sh in _shingles(txt)]
+    return tuple(min((a*h+b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS)
+
+
+def estimate_similarity(txt0, txt1):
+    """Estimated Jaccard similarity of the shingle sets of two strings, between 0 and 1."""
+    sig0 = minhash_signature(txt0)
+    sig1 = minhash_signature(txt1)
+    return sum(1 for x, y in zip(sig0, sig1) if x == y)/len(sig0)
+
+
+def _num_len_limit_calls(mem, max_lengths):
+    """How many len_limit AI calls a memory would cost as it ages through max_lengths (an estimate)."""
+    nw = len(mem.strip().split(' '))
+    return len(set([ml for ml in max_lengths if ml < nw]))
+
+
+def drop_near_duplicates(memories, new_memories, threshold=DEDUP_THRESHOLD, lookback=DEDUP_LOOKBACK, max_lengths=None, render_f=str):
+    """
+    Removes the new memories that are near-duplicates of a recent memory (or of an earlier new memory).
+    Runs before any summarization so that repeated memories never cost an AI call.
+
+    Parameters:
+      memories: The list of memories already held.
+      new_memories: The new memories.
+      threshold=DEDUP_THRESHOLD: Similarity at or above which a new memory is dropped. A falsy value disables the check.
+      lookback=DEDUP_LOOKBACK: How many of the most recent memories to compare against.
+      max_lengths=None: Per-memory length limits, used to count how many len_limit calls were avoided.
+      render_f=str: Function from a memory to its text.
+
+    Returns the list of new memories to keep. Updates dedup_stats.
+    """
+    if not threshold:
+        return list(new_memories)
+    recent = [render_f(old) for old in memories[-lookback:]] if lookback > 0 else []
+    kept = []
+    for mem in new_memories:
+        txt = render_f(mem)
+        dedup_stats['checked'] += 1
+        if any(estimate_similarity(txt, old) >= threshold for old in recent):
+            dedup_stats['dropped'] += 1
+            if max_lengths:
+                dedup_stats['llm_calls_avoided'] += _num_len_limit_calls(txt, max_lengths)
+            continue
+        kept.append(mem)
+        recent.append(txt)
+    return kept
+
+
+######################## Fresh memories #################################
+
 def summarize_fresh_spoken_memory(speaker, where_speaker_is, txt):
     """Summarizes a spoken memory."""
 
@@ -66,17 +138,54 @@ def summarize_fresh_move_memory(speaker, where_speaker_is, next_loc):
     return speaker + ' travelled from the '+ where_speaker_is + ' to the '+ next_loc
 
 
+######################## Memory records #################################
+
+SPOKEN, OBSERVED, THOUGHT, MOVED, SUMMARY = range(5) # The kinds of Memory.
+
+
+class Memory():
+    """
+    A compact memory record. The text that a person remembers is only rendered when the prompt is built (see MMOWorld.render_memory),
+    so that everyone who heard the same thing can share one Memory object.
+
+    Attributes:
+      speaker: Interned id of who spoke, saw, thought or moved. -1 for a SUMMARY.
+      kind: One of SPOKEN, OBSERVED, THOUGHT, MOVED or SUMMARY.
+      where: Interned id of the location. -1 for a SUMMARY.
+      txt: What was spoken, seen or thought. The interned id of the destination for MOVED. The full text (from the owner's point of view) for a SUMMARY.
+    """
+    __slots__ = ['speaker', 'kind', 'where', 'txt']
+
+    def __init__(self, speaker, kind, where, txt):
+        self.speaker = speaker
+        self.kind = kind
+        self.where = where
+        self.txt = txt
+
+    def to_list(self):
+        return [self.speaker, self.kind, self.where, self.txt]
+
+    def __eq__(self, other):
+        return isinstance(other, Memory) and self.to_list() == other.to_list()
+
+    def __hash__(self):
+        return hash((self.speaker, self.kind, self.where, self.txt))
+
+    def __repr__(self):
+        return 'Memory'+str(tuple(self.to_list()))
+
+
+def summary_memory(txt):
+    """A Memory that is already text, such as a summary made by the AI."""
+    return Memory(-1, SUMMARY, -1, txt)
+
+
 ######################## AI support functions #################################
 
 
-async def len_limit(mem, numword):
-    """Uses AI to limit the length of a message. If the AI fails to summarize the message, it will limit the length."""
-    if numword==0:
-        return ''
-    mem = mem.strip()
-    if len(mem.split(' '))<=numword:
-        return mem
-    prompt = '''
+async def _summarize_one(mem, numword):
+    """A single AI call that summarizes mem to at most numword words."""
+    prompt = f'''
 # Instructions
 
 You are to summarize the next message after this one. The summary must be at most {numword} words.
@@ -85,7 +194,113 @@ You are to summarize the next message after this one. The summary must be at mos
 
 You must return your response as a list of words and/or sentences. The maximum number of words total is {numword}.
 '''
-    out = await gpt.gpt_get_answer([{'role':'system', 'content':prompt}, {'role':'user', 'content':mem}])
+    return await gpt.gpt_get_answer([{'role':'system', 'content':prompt}, {'role':'user', 'content':mem}], call_type='summary')
+
+
+async def _summarize_packed(jobs):
+    """
+    Summarizes many (mem, numword) jobs with a single AI call.
+    The jobs go in as a JSON array and come back as a JSON array (via Structured Response).
+    Returns a list of summaries in the same order as the jobs. Raises an Exception if the response does not parse or is missing jobs.
+    """
+    prompt = '''
+# Instructions
+
+You are summarizing several unrelated messages. The next message is a JSON array of objects, each with an "id", a "max_words" and a "text".
+Summarize each text on its own. Each summary must be at most "max_words" words.
+
+# Response format
+
+Return one summary for every id, using the same id.
+'''
+    packed = json.dumps([{'id':i, 'max_words':numword, 'text':mem} for i, (mem, numword) in enumerate(jobs)], ensure_ascii=False)
+    out = await gpt.gpt_get_answer([{'role':'system', 'content':prompt}, {'role':'user', 'content':packed}], response_format=gpt.Summaries, call_type='summary_packed')
+    if type(out) is str:
+        out = json.loads(out)
+    summaries = {}
+    for x in out['summaries']:
+        summaries[int(x['id'])] = str(x['summary'])
+    if len(summaries) != len(jobs) or set(summaries.keys()) != set(range(len(jobs))):
+        raise Exception(f'Packed summary has ids {sorted(summaries.keys())} but there were {len(jobs)} jobs.')
+    return [summaries[i] for i in range(len(jobs))]
+
+
+class SummaryPacker():
+    """
+    Packs summarization jobs that are requested at about the same time (i.e. by every listener of a step) into one AI call.
+    Transparent to the caller: summarize() returns the same thing a single call would.
+    Falls back to one call per job if the packed response cannot be used.
+    """
+    def __init__(self, max_batch=32, wait=0.02):
+        """
+        Parameters:
+          max_batch=32: The most jobs in one AI call. Reaching this sends the call right away.
+          wait=0.02: How many seconds to wait for more jobs before sending the call.
+        """
+        self.max_batch = max_batch
+        self.wait = wait
+        self.pending = [] # [mem, numword, future, channel (in the AI call ledger)]
+        self.flush_task = None
+        self.stats = {'jobs':0, 'requests':0, 'fallbacks':0} # Running totals since startup.
+
+    async def summarize(self, mem, numword):
+        """Summarizes mem to (about) numword words, sharing the AI call with other jobs."""
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append([mem, numword, fut, llm_ledger.get_context()[0]])
+        self.stats['jobs'] += 1
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif not self.flush_task:
+            self.flush_task = asyncio.create_task(self._flush_later())
+        return await fut
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.wait)
+        self.flush_task = None
+        self._flush()
+
+    def _flush(self):
+        batch = self.pending
+        self.pending = []
+        if batch:
+            channels = set([x[3] for x in batch])
+            with llm_ledger.context(channel=channels.pop() if len(channels) == 1 else '(shared)'): # A call packing several channels' jobs is not any one channel's.
+                asyncio.create_task(self._run(batch))
+
+    async def _run(self, batch):
+        jobs = [(x[0], x[1]) for x in batch]
+        futs = [x[2] for x in batch]
+        outs = None
+        if len(jobs) > 1:
+            try:
+                self.stats['requests'] += 1
+                outs = await _summarize_packed(jobs)
+            except Exception as e:
+                logger.warning(f'Packed summary of {len(jobs)} memories failed, falling back to one call each: {e}')
+                self.stats['fallbacks'] += 1
+        if outs is None:
+            self.stats['requests'] += len(jobs)
+            outs = await asyncio.gather(*[_summarize_one(mem, numword) for mem, numword in jobs], return_exceptions=True)
+        for fut, out in zip(futs, outs):
+            if fut.done():
+                continue
+            if isinstance(out, BaseException):
+                fut.set_exception(out)
+            else:
+                fut.set_result(out)
+
+
+summary_packer = SummaryPacker()
+
+
+async def len_limit(mem, numword):
+    """Uses AI to limit the length of a message. If the AI fails to summarize the message, it will limit the length."""
+    if numword==0:
+        return ''
+    mem = mem.strip()
+    if len(mem.split(' '))<=numword:
+        return mem
+    out = await summary_packer.summarize(mem, numword)
     pieces = out.strip().split(' ')
     if len(pieces)<=numword:
         return out
@@ -95,13 +310,13 @@ You must return your response as a list of words and/or sentences. The maximum n
     return out
 
 
-async def append_simplify_memories(memories, new_memories, max_lengths=None, max_memories=64, num_compress=8):
+async def append_simplify_memories(memories, new_memories, max_lengths=None, max_memories=64, num_compress=8, dedup_threshold=DEDUP_THRESHOLD, render_f=None):
     """
     Appends this memory to list-valued "the_memory".
     Summarizes memories to limit the length of older memories and the total number of memories.
 
     Parameters:
-      memories: The list of memory strings.
+      memories: The list of memories, strings unless render_f is given.
       new_memories: New memories to be added to the list.
       max_lengths=None: Max per-memory length, in reverse chronological order.
         Generally a descending sequence as more recent memories are more detailed.
@@ -109,32 +324,50 @@ async def append_simplify_memories(memories, new_memories, max_lengths=None, max
         A default will be used if not supplied.
       max_memories=64: The maximum number of memories. This is a different limit than the per-memory limit.
       num_compress=8: If the number of memories exceeds max_memories, shrink it by this interval (by summarizing) untill it fits.
+      dedup_threshold=DEDUP_THRESHOLD: New memories this similar to a recent memory are dropped before any summarization. A falsy value keeps them all.
+      render_f=None: Function from a Memory to its text. If given, memories are Memory records and shortened ones become SUMMARY records.
 
     Returns the new memory list.
     """
+    if not max_lengths:
+        max_lengths = [256, 128, 64, 32, 16, 8, 7, 6]
+    if render_f:
+        wrap_f = summary_memory
+    else:
+        render_f = wrap_f = str
 
+    # Repeated observations and speech heard twice do not need to be remembered (and summarized) twice:
+    new_memories = drop_near_duplicates(memories, new_memories, threshold=dedup_threshold, max_lengths=max_lengths, render_f=render_f)
     memories.extend(new_memories)
 
     # Shorten single memories:
-    if not max_lengths:
-        max_lengths = [256, 128, 64, 32, 16, 8, 7, 6]
     max_lengths = max_lengths+[max_lengths[-1]]*len(memories)
+    txts = [render_f(m) for m in memories]
+    len_tasks = []
     for i in range(len(memories)):
         age = len(memories)-i-1 # Zero for the most recent memory.
         numword = max_lengths[age]
-        memories[i] = await len_limit(memories[i], numword)
+        len_tasks.append(len_limit(txts[i], numword))
+    short_txts = await asyncio.gather(*len_tasks) # All at once so that the summary_packer can pack them.
+    for i, short_txt in enumerate(short_txts):
+        if short_txt != txts[i]:
+            memories[i] = wrap_f(short_txt)
+            txts[i] = short_txt
 
     # Summarize multiple memories at a time if the total list grows too long:
-    num_compress = 8
     if num_compress<1:
         num_compress = 1
     while len(memories) > max_memories:
-        compressed_mem = await len_limit('\n'.join(memories[0:num_compress]))
-        memories = [compressed_mem]+memories[num_compress+1:]
+        compressed_txt = await len_limit('\n'.join(txts[0:num_compress]), max_lengths[-1])
+        memories = [wrap_f(compressed_txt)]+memories[num_compress:]
+        txts = [compressed_txt]+txts[num_compress:]
 
     return memories
 
 
+MAX_IDLE_SKIPS = 8 # Someone out of sight of the human users (or idle) is skipped at most this many times in a row.
+
+
 class MMOWorld():
     """Contains locations, people, and places."""
     # TODO: JSON load and save.
@@ -161,11 +394,18 @@ class MMOWorld():
                       'DoryFish':'You are happy, good natured, and excited.'}
         self.locations = locations
         self.people = people
-        self.people_memories = {} # The memories of each person.
+        self.people_memories = {} # The memories (lists of Memory records) of each person.
         self.people_where = {}
         for name in people.keys():
             self.people_where[name] = random.choice(_locs)
         self.speaker_history = [] # [speaker_name, spoken_mem, where_speaker_is]
+        self.unconsolidated = {} # How many of the most recent memories of each person have not been summarized yet.
+        self.version = 0 # Incremented each time the world is saved. Used to detect (and merge) concurrent changes, see merge_worlds.
+        self.base = None # The stored dict this world was loaded from (not saved), or None if it is a new world.
+        self.interned = [] # Names and places used by Memory records, which store the index instead of the string.
+        self.fresh_memories = {} # How many memories each person got from others since they last spoke.
+        self.idle_skips = {} # How many turns in a row each person has been skipped while out of sight of the human users or idle.
+        self._intern_ids = {}
 
     def compat(self):
         """Makes sure that the world is self-compatable, i.e. does not have data that disagrees with other data."""
@@ -181,6 +421,119 @@ class MMOWorld():
         for name, place in self.people_where.items():
             if place not in self.locations:
                 self.people_where[name] = random.choice(locs)
+        for name in list(self.unconsolidated.keys()):
+            if name not in self.people_memories:
+                del self.unconsolidated[name]
+            else:
+                self.unconsolidated[name] = min(self.unconsolidated[name], len(self.people_memories[name]))
+
+    def intern(self, x):
+        """The id of a name or place string, adding it if it is new."""
+        if len(self._intern_ids) != len(self.interned):
+            self._intern_ids = {s:i for i, s in enumerate(self.interned)}
+        if x not in self._intern_ids:
+            self._intern_ids[x] = len(self.interned)
+            self.interned.append(x)
+        return self._intern_ids[x]
+
+    def render_memory(self, mem, viewer):
+        """The text of a Memory as remembered by viewer, who refers to themselves as "I"."""
+        if mem.kind == SUMMARY:
+            return mem.txt
+        speaker = self.interned[mem.speaker]
+        if speaker == viewer:
+            speaker = 'I'
+        where = self.interned[mem.where]
+        if mem.kind == SPOKEN:
+            return summarize_fresh_spoken_memory(speaker, where, mem.txt)
+        if mem.kind == OBSERVED:
+            return summarize_fresh_observation_memory(speaker, where, mem.txt)
+        if mem.kind == THOUGHT:
+            return summarize_fresh_thought_memory(speaker, where, mem.txt)
+        return summarize_fresh_move_memory(speaker, where, self.interned[mem.txt])
+
+    def memory_texts(self, name):
+        """The memories of a person as a list of strings."""
+        return [self.render_memory(mem, name) for mem in self.people_memories.get(name, [])]
+
+    def pick_next_speaker(self, human_locations=None):
+        """
+        Chooses who the AI speaks as next. Round-robin, but it prefers people who someone will hear:
+          1. People who have been passed over MAX_IDLE_SKIPS times in a row (so that nobody starves).
+          2. People with someone else to talk to or something new to respond to, in a location with human users.
+          3. Other such people.
+        If everyone is idle (alone and with nothing new heard), the plain round-robin choice is used.
+
+        Parameters:
+          human_locations=None: The locations that have human users in them. 'all' means the humans are everywhere.
+        """
+        names = sorted(list(self.people.keys()))
+        last_speaker = 'no last speaker'
+        for speaker, _, _ in reversed(self.speaker_history):
+            if speaker in names:
+                last_speaker = speaker
+                break
+        if last_speaker in names:
+            ix = names.index(last_speaker)+1
+            names = names[ix:]+names[0:ix] # Round-robin order, starting after the last speaker.
+
+        human_locations = set(human_locations or [])
+        crowd = {}
+        for name in names:
+            loc = self.people_where.get(name)
+            crowd[loc] = crowd.get(loc, 0)+1
+        def _is_active(name):
+            loc = self.people_where.get(name)
+            return crowd[loc] > 1 or loc in human_locations or 'all' in human_locations or self.fresh_memories.get(name, 0) > 0
+        def _humans_here(name):
+            return self.people_where.get(name) in human_locations or 'all' in human_locations
+
+        seen = [name for name in names if _is_active(name) and _humans_here(name)]
+        tiers = [[name for name in names if self.idle_skips.get(name, 0) >= MAX_IDLE_SKIPS],
+                 seen,
+                 [name for name in names if _is_active(name)],
+                 names]
+        speaker_name = [tier for tier in tiers if tier][0][0]
+
+        for name in names:
+            if name == speaker_name:
+                self.idle_skips[name] = 0
+            elif name not in seen:
+                self.idle_skips[name] = self.idle_skips.get(name, 0)+1
+        return speaker_name
+
+    def export_person(self, name):
+        """
+        Removes a person from this world and returns them as a dict with plain strings instead of interned ids,
+        so that import_person can add them to another world (i.e. the one run by another shard).
+        """
+        def _export(mem):
+            if mem.kind == SUMMARY:
+                return [None, SUMMARY, None, mem.txt]
+            txt = self.interned[mem.txt] if mem.kind == MOVED else mem.txt
+            return [self.interned[mem.speaker], mem.kind, self.interned[mem.where], txt]
+        out = {'name':name, 'personality':self.people.pop(name, ''), 'where':self.people_where.pop(name, None),
+               'memories':[_export(mem) for mem in self.people_memories.pop(name, [])]}
+        for ky in ['unconsolidated', 'fresh_memories', 'idle_skips']:
+            out[ky] = getattr(self, ky).pop(name, 0)
+        return out
+
+    def import_person(self, person):
+        """Adds a person made by export_person."""
+        def _import(row):
+            speaker, kind, where, txt = row
+            if kind == SUMMARY:
+                return summary_memory(txt)
+            if kind == MOVED:
+                txt = self.intern(txt)
+            return Memory(self.intern(speaker), kind, self.intern(where), txt)
+        name = person['name']
+        self.people[name] = person['personality']
+        if person['where']:
+            self.people_where[name] = person['where']
+        self.people_memories[name] = [_import(row) for row in person['memories']]
+        for ky in ['unconsolidated', 'fresh_memories', 'idle_skips']:
+            getattr(self, ky)[name] = person[ky]
 
     def get_prepend(self, use_reAct, location, speakers_here, speaker_name, has_memory):
         """This is the system part of the prompt that goes before the memory itself."""
@@ -253,7 +606,51 @@ class MMOWorld():
             prepend = [{'role':'system', 'content':first_message}]
         return prepend
 
-    async def step_world(self, speaker_name=None, location=None, txt=None, is_reAct=False, send_message_f=None):
+    async def consolidate_memories(self, send_message_f=None):
+        """
+        Summarizes the memories that step_world appended but did not consolidate.
+        Can run alongside steps: memories appended meanwhile are kept after the summary, and lists that were
+        cleared or replaced meanwhile (or people who left) are left alone.
+
+        Parameters:
+          send_message_f=None: Optional function (name, txt, location, transient) for sending a notice that consolidation is happening.
+
+        Returns the names whose memories were consolidated.
+        """
+        pending = {}
+        for name, n in self.unconsolidated.items():
+            if n > 0 and name in self.people:
+                pending[name] = n
+        if not pending:
+            return []
+
+        if send_message_f: # Only those where it happens see the notice.
+            pending_where = {}
+            for name in pending.keys():
+                loc = self.people_where.get(name, 'all')
+                pending_where[loc] = pending_where.get(loc, [])+[name]
+            for loc, names in pending_where.items():
+                send_message_f(None, f'<{names} are consolidating thier memories>', loc, transient=True)
+        mems_before = {}
+        mems_tasks = {}
+        for name, n in pending.items():
+            mems = self.people_memories.get(name, [])
+            mems_before[name] = mems
+            render_f = functools.partial(self.render_memory, viewer=name)
+            mems_tasks[name] = append_simplify_memories(memories=mems[:-n], new_memories=mems[-n:], render_f=render_f)
+        mems_consolidated = dict(zip(mems_tasks.keys(), await asyncio.gather(*mems_tasks.values())))
+
+        for name, v in mems_consolidated.items():
+            mems = mems_before[name]
+            current = self.people_memories.get(name, [])
+            if name not in self.people or current[0:len(mems)] != mems: # Changed other than by appending while the AI was summarizing.
+                continue
+            self.people_memories[name] = v+current[len(mems):]
+            self.unconsolidated[name] = len(current)-len(mems)
+        logger.info(f'Consolidated the memories of {list(pending.keys())}. Totals of this process: dedup {dedup_stats}, summary packing {summary_packer.stats}')
+        return list(pending.keys())
+
+    async def step_world(self, speaker_name=None, location=None, txt=None, is_reAct=False, send_message_f=None, consolidate=True, human_locations=None):
         """
         Takes a step in the conversation, updating the history and saving the message.
         Also people can move around.
@@ -264,21 +661,18 @@ class MMOWorld():
            location=None: Where they are speaking. None will use the current NPC's location. 'all' will be heard in all locations.
            txt=None: The text they speak. None will use the AI to come up with the text.
            is_reAct=False: Special reAct mode (https://arxiv.org/pdf/2210.03629)
-           send_message_f=None: Optional function (name, txt) of a string for sending messages at intermediate steps.
+           send_message_f=None: Optional function (name, txt, location, transient=False) of a string for sending messages at intermediate steps.
               Not async! But it can still call an asyncio task to be scheduled for non-blocking usage.
+              location is where the message can be heard, 'all' or None for everywhere.
+              transient messages (i.e. '<thinking>') are progress notices that can be skipped once a later message is ready.
+           consolidate=True: Summarize the new memories before returning.
+              If False they are appended raw and consolidate_memories() should be called later, off the critical path.
+           human_locations=None: Where the human users are, used to choose an AI speaker someone will hear (see pick_next_speaker).
         """
         names = sorted(list(self.people.keys()))
 
         if not speaker_name:
-            # Round-robin speakers:
-            if self.speaker_history:
-                last_speaker = self.speaker_history[-1][0]
-            else:
-                last_speaker = 'no last speaker'
-            if last_speaker in names:
-                speaker_name = (names+[names[0]])[names.index(last_speaker)+1]
-            else:
-                speaker_name = names[0]
+            speaker_name = self.pick_next_speaker(human_locations)
         if not speaker_name in self.people and not txt:
             raise Exception("AI but no speaker speaking.")
 
@@ -307,11 +701,11 @@ class MMOWorld():
 
             # Load the memory:
             #the_messages = prepend+[{'role':'user', 'user_id':who, 'content':txt} for who, txt, where in speaker_memory]
-            the_messages = prepend+[{'role':'user', 'content':mem} for mem in speaker_memory]
+            the_messages = prepend+[{'role':'user', 'content':self.render_memory(mem, speaker_name)} for mem in speaker_memory]
 
             if send_message_f:
-                send_message_f(speaker_name, '<thinking>')
-            gpt_txt = await gpt.gpt_get_answer(the_messages)
+                send_message_f(speaker_name, '<thinking>', where_speaker_is, transient=True)
+            gpt_txt = await gpt.gpt_get_answer(the_messages, call_type='npc_speech')
             with open('debug/debug_last_prompt.txt', 'w') as f:
                 json.dump(the_messages, f, indent=3)
             if is_reAct:
@@ -352,61 +746,176 @@ class MMOWorld():
                 msg = "Observation:\n"+observation+'\n\nThought:\n'+thought+'\n\nSpeech:\n'+speech+'\n\nAction:\n'+action
             else:
                 msg = speech
-            send_message_f(speaker_name, msg)
+            send_message_f(speaker_name, msg, where_speaker_is)
 
         observation_mem = thought_mem = spoken_mem = move_mem = None
+        speaker_id = self.intern(speaker_name)
+        where_id = self.intern(where_speaker_is)
         if speech:
             self.speaker_history.append([speaker_name, speech, where_speaker_is])
-            spoken_mem = summarize_fresh_spoken_memory(speaker_name, where_speaker_is, speech)
+            spoken_mem = Memory(speaker_id, SPOKEN, where_id, speech)
         if observation:
-            observation_mem = summarize_fresh_observation_memory(speaker_name, where_speaker_is, observation)
+            observation_mem = Memory(speaker_id, OBSERVED, where_id, observation)
         if thought:
-            thought_mem = summarize_fresh_thought_memory(speaker_name, where_speaker_is, thought)
+            thought_mem = Memory(speaker_id, THOUGHT, where_id, thought)
         if next_loc and next_loc != where_speaker_is:
-            move_mem = summarize_fresh_move_memory(speaker_name, where_speaker_is, next_loc)
+            move_mem = Memory(speaker_id, MOVED, where_id, self.intern(next_loc))
 
-        # Store the memory:
+        # Store the memory (the same Memory is shared by everyone who heard it):
         new_mems = {} # Name to list of new memories.
         for i, new_memory in enumerate([observation_mem, thought_mem, spoken_mem, move_mem]):
             if new_memory:
-                new_mems[speaker_name] = new_mems.get(speaker_name, []) + [new_memory.replace(speaker_name, 'I')]
+                new_mems[speaker_name] = new_mems.get(speaker_name, []) + [new_memory]
                 if i in [2, 3]: # Spoken and move memories can be "seen" by others in the place (note: for now they see who left, not who entered).
                     for name in speakers_here:
                         if name != speaker_name:
                             new_mems[name] = new_mems.get(name, []) + [new_memory]
 
-        mems_tasks = {}
+        if speaker_name in self.people:
+            self.fresh_memories[speaker_name] = 0
         for name, v in new_mems.items():
+            if name != speaker_name:
+                self.fresh_memories[name] = self.fresh_memories.get(name, 0)+len(v)
             if name != 'DoryFish' and name in self.people: # Finding Nemo
-                mems_tasks[name] = append_simplify_memories(memories=self.people_memories.get(name, []), new_memories=v)
-
-        if len(mems_tasks) > 0:
-            send_message_f(None, f'<{list(mems_tasks.keys())} are consolidating thier memories>')
-        mems_consolidated = dict(zip(mems_tasks.keys(), await asyncio.gather(*mems_tasks.values())))
-
-        for name, v in mems_consolidated.items():
-            self.people_memories[name] = v
+                self.people_memories[name] = self.people_memories.get(name, [])+v
+                self.unconsolidated[name] = self.unconsolidated.get(name, 0)+len(v)
+        if consolidate:
+            await self.consolidate_memories(send_message_f)
 
         if next_loc and next_loc != where_speaker_is and send_message_f:
-            send_message_f(speaker_name, 'I moved from the: '+where_speaker_is+' to the: '+next_loc)
+            send_message_f(speaker_name, 'I moved from the: '+where_speaker_is+' to the: '+next_loc, where_speaker_is)
 
         if next_loc and speaker_name in self.people:
             self.people_where[speaker_name] = next_loc
 
         if send_message_f:
-            send_message_f(None, 'The AI step has been completed')
+            send_message_f(None, 'The AI step has been completed', where_speaker_is)
 
     def to_dict(self):
         """Convert the world to and from a dict for storage to the disk."""
         out = {}
-        for ky in ['locations', 'people', 'people_memories', 'people_where', 'speaker_history']:
+        for ky in _WORLD_KEYS:
             out[ky] = getattr(self, ky)
+
+        # Each distinct Memory is stored once as a [speaker, kind, where, txt] row; people store row indexes:
+        records = []
+        record_ids = {}
+        people_memories = {}
+        for name, mems in self.people_memories.items():
+            ixs = []
+            for mem in mems:
+                if mem not in record_ids:
+                    record_ids[mem] = len(records)
+                    records.append(mem.to_list())
+                ixs.append(record_ids[mem])
+            people_memories[name] = ixs
+        out['people_memories'] = people_memories
+        out['memory_records'] = records
         return out
 
 
+_WORLD_KEYS = ['locations', 'people', 'people_memories', 'people_where', 'speaker_history', 'unconsolidated', 'version', 'interned', 'fresh_memories', 'idle_skips']
+
+
 def from_dict(d):
     """Convert the world to and from a dict for storage to the disk."""
     out = MMOWorld()
-    for ky in ['locations', 'people', 'people_memories', 'people_where', 'speaker_history']:
-        setattr(out, ky, d[ky])
+    for ky in _WORLD_KEYS:
+        if ky in d: # Worlds saved by older versions lack some keys.
+            setattr(out, ky, copy.deepcopy(d[ky])) # Copy so that changes to this world do not leak into the stored dict.
+
+    if 'memory_records' in d:
+        records = [Memory(*row) for row in d['memory_records']]
+        out.people_memories = {name:[records[ix] for ix in ixs] for name, ixs in out.people_memories.items()}
+    else: # Older worlds stored the text of each memory.
+        out.people_memories = {name:[summary_memory(txt) for txt in mems] for name, mems in out.people_memories.items()}
+    out.base = dict(d)
+    return out
+
+
+def _merge_appended(base, ours, theirs, ours_yields=False, theirs_rebuilt=False):
+    """
+    Three-way merge of lists that grow at the end (but can also be rewritten, i.e. by consolidation or by clearing).
+    Returns (merged, head, tail_len): head is 'ours' or 'theirs', whichever list the merged one starts with,
+    and tail_len how many items appended by the other side follow it.
+
+    Parameters:
+      ours_yields=False: If both sides rewrote the list, keep theirs instead of ours. For when ours only consolidated
+        (summarized) the list, which must not bring back memories that were cleared or replaced meanwhile.
+      theirs_rebuilt=False: Theirs was made from scratch (i.e. by Reset), so its items can't be compared with base;
+        it counts as rewritten.
+    """
+    if ours == base:
+        return theirs, 'theirs', 0
+    theirs_kept_base = not theirs_rebuilt and theirs[0:len(base)] == base
+    if theirs_kept_base and len(theirs) == len(base):
+        return ours, 'ours', 0
+    if ours[0:len(base)] == base:
+        return theirs+ours[len(base):], 'theirs', len(ours)-len(base)
+    if theirs_kept_base:
+        return ours+theirs[len(base):], 'ours', len(theirs)-len(base)
+    if ours_yields:
+        logger.info('Merge conflict: the list was rewritten while it was being consolidated, dropping the consolidation.')
+        return theirs, 'theirs', 0
+    logger.warning('Merge conflict: both sides rewrote the same list, keeping ours.')
+    return ours, 'ours', 0
+
+
+def merge_worlds(base, ours, theirs, ours_consolidated=False):
+    """
+    Three-way merge of two worlds that were both changed starting from base (i.e. by concurrent steps on the same channel).
+    Changes that do not conflict are all kept. Memories and the speaker history are treated as growing lists,
+    so memories appended by one side are kept after the memories consolidated by the other.
+    When both sides changed the same thing in different ways, ours wins, unless ours only consolidated memories.
+
+    Parameters:
+      base: The world both sides started from.
+      ours: The world being saved.
+      theirs: The world that was saved in the meantime.
+      ours_consolidated=False: Ours is the result of consolidate_memories. Memories that were cleared or replaced
+        in theirs (i.e. "Delete memories", Prompt-people or Reset) stay that way instead of coming back summarized.
+
+    Returns the merged world, which is theirs modified in place.
+    """
+    out = theirs
+    theirs_rebuilt = out.interned[0:len(base.interned)] != base.interned # Interned strings are only ever appended, unless the world was made anew (Reset).
+
+    def _reintern(mem): # The ids in ours can differ from the ids in theirs for strings that both sides added. Also works on base, whose interned strings start those of ours.
+        if mem.kind == SUMMARY:
+            return mem
+        speaker = out.intern(ours.interned[mem.speaker])
+        where = out.intern(ours.interned[mem.where])
+        txt = out.intern(ours.interned[mem.txt]) if mem.kind == MOVED else mem.txt
+        return Memory(speaker, mem.kind, where, txt)
+
+    missing = object()
+    for ky in ['locations', 'people', 'people_where']: # Edited key by key.
+        b = getattr(base, ky)
+        o = getattr(ours, ky)
+        t = getattr(out, ky)
+        for k in set(b.keys()) | set(o.keys()):
+            if o.get(k, missing) != b.get(k, missing):
+                if k in o:
+                    t[k] = o[k]
+                else:
+                    t.pop(k, None)
+    for ky in ['fresh_memories', 'idle_skips']: # Counters.
+        b = getattr(base, ky)
+        o = getattr(ours, ky)
+        t = getattr(out, ky)
+        for k in set(b.keys()) | set(o.keys()):
+            t[k] = max(0, t.get(k, 0)+o.get(k, 0)-b.get(k, 0))
+
+    out.speaker_history, _, _ = _merge_appended(base.speaker_history, ours.speaker_history, out.speaker_history, theirs_rebuilt=theirs_rebuilt)
+
+    for name in set(base.people_memories.keys()) | set(ours.people_memories.keys()):
+        mems_base = base.people_memories.get(name, [])
+        if theirs_rebuilt: # So that base can be compared with ours, which is in the ids of theirs.
+            mems_base = [_reintern(mem) for mem in mems_base]
+        mems_ours = [_reintern(mem) for mem in ours.people_memories.get(name, [])]
+        mems_theirs = out.people_memories.get(name, [])
+        merged, head, tail_len = _merge_appended(mems_base, mems_ours, mems_theirs, ours_yields=ours_consolidated, theirs_rebuilt=theirs_rebuilt)
+        head_world = ours if head == 'ours' else out
+        out.unconsolidated[name] = head_world.unconsolidated.get(name, 0)+tail_len
+        out.people_memories[name] = merged
     return out
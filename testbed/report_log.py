@@ -0,0 +1,103 @@
+# Test reports as append-only JSONL (one entry per line), written in the background so that reporting stays cheap
+# however long the test run is. load_reports() gives back the list that the old logs/reports*.json files held.
+# Run as a script to convert a report to that list format: python report_log.py logs/reportsuser.jsonl [out.json]
+import json, os, sys, asyncio, threading, atexit
+
+from loguru import logger
+from moobius import json_utils
+
+
+class ReportLog():
+    """
+    Buffers report entries and appends them to a JSONL file at most every flush_interval seconds (sooner if
+    max_buffer entries are waiting). The writing happens in a thread, not on the event loop. Without a running
+    event loop (i.e. at startup) entries are written right away. Whatever is buffered is written at exit.
+    """
+    def __init__(self, path, flush_interval=1.0, max_buffer=256):
+        """
+        Parameters:
+          path: The .jsonl file. Its folder is made if needed.
+          flush_interval=1.0: Seconds between background writes.
+          max_buffer=256: Buffered entries that trigger a write before the interval is up.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.count = 0 # Entries appended since the last clear().
+        self._buffer = [] # JSON lines not yet written.
+        self._lock = threading.Lock() # Guards the buffer and the file, since flushing happens in a thread.
+        self._flusher = None # The asyncio.Task of _flush_loop.
+        self._wake = None # asyncio.Event that makes the flusher write early.
+        atexit.register(self.flush)
+
+    def append(self, x):
+        """Adds an entry (anything enhanced_json_save can save, i.e. dataclasses). It is serialized now, so later changes to x are not reported."""
+        line = json.dumps(json_utils.marked_recursive_undataclass(x, True), ensure_ascii=False)+'\n'
+        with self._lock:
+            self._buffer.append(line)
+            self.count += 1
+            n_buffered = len(self._buffer)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError: # No event loop to flush from.
+            self.flush()
+            return
+        if not self._flusher or self._flusher.done():
+            self._wake = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+        elif n_buffered >= self.max_buffer:
+            self._wake.set()
+
+    def clear(self):
+        """Empties the file and drops anything buffered."""
+        with self._lock:
+            self._buffer = []
+            self.count = 0
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8'):
+                pass
+
+    def flush(self):
+        """Writes out what is buffered. Blocking; the background flusher runs it in a thread."""
+        with self._lock:
+            lines = self._buffer
+            self._buffer = []
+            if not lines:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(lines))
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f'Could not write the test report {self.path}: {e}')
+
+
+def load_reports(path):
+    """The list of entries in a report file, dataclasses restored (as enhanced_json_load would). A torn last line is skipped."""
+    out = []
+    if not os.path.exists(path):
+        return out
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break # Still being written.
+            out.append(json_utils.marked_recursive_dataclass(json.loads(line)))
+    return out
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise Exception('Usage: python report_log.py <report.jsonl> [out.json]')
+    reports = load_reports(sys.argv[1])
+    txt = json_utils.enhanced_json_save(sys.argv[2] if len(sys.argv) > 2 else None, reports)
+    if len(sys.argv) <= 2:
+        print(txt)
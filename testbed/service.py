@@ -4,32 +4,28 @@ import copy
 from datetime import datetime
 
 from loguru import logger
-from moobius import Moobius, MoobiusStorage, json_utils
+from moobius import Moobius, MoobiusStorage
 from moobius.database.storage import CachedDict
 import moobius.types as types
 from moobius.types import Button, CanvasItem, StyleItem, MenuItem, MessageBody, InputComponent, Dialog
 
+import report_log
+
 
 this_folder = os.path.dirname(__file__)
-tmp_file = this_folder + '/logs/reportsservice.json'
+tmp_file = this_folder + '/logs/reportsservice.jsonl' # Read it with report_log.load_reports().
+report_log_ = report_log.ReportLog(tmp_file)
 
 
 def clear_tmp_file():
     """Clears the tmp testing file. Called once at the beginning."""
-    if os.path.exists(tmp_file):
-        os.remove(tmp_file)
-    with open(tmp_file,'w', encoding='utf-8') as f:
-        json.dump([], f)
+    report_log_.clear()
 
 
 def save_to_tmp_file(x):
-    """Saves (usally a test) to a temp file for automatic testing."""
-    with open(tmp_file,'r', encoding='utf-8') as f:
-        the_list = json.load(f)
-    print(f"SAVING to service file. Current number of stored entries: {len(the_list)}")
-    the_list.append(x)
-    with open(tmp_file,'w', encoding='utf-8') as f:
-        json_utils.enhanced_json_save(f, the_list)
+    """Saves (usally a test) to a temp file for automatic testing. Buffered; written to the file in the background."""
+    report_log_.append(x)
+    print(f"SAVING to service file. Current number of stored entries: {report_log_.count}")
 
 
 import random; random1 = str(random.random())